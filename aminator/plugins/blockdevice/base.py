@@ -54,6 +54,21 @@ class BaseBlockDevicePlugin(BasePlugin):
             log.debug('Exception encountered in block device plugin', exc_info=(typ, val, trc))
         return False
 
+    def lock_dev(self, dev):
+        """
+        take the allocation lock on a device outside the context manager, e.g. to hand a device
+        over to a deferred cleanup. Returns a handle for release_dev, or None if the plugin
+        does not lock devices
+        """
+        return None
+
+    def release_dev(self, dev):
+        pass
+
+    def detached(self, dev):
+        """ called once the volume attached at device node dev has been detached """
+        pass
+
     def __call__(self, cloud):
         """
         By default, BlockDevicePlugins are called using
@@ -32,6 +32,7 @@ from aminator.config import conf_action
 from aminator.exceptions import DeviceException
 from aminator.plugins.blockdevice.base import BaseBlockDevicePlugin
 from aminator.util.linux import flock, locked, native_device_prefix
+from aminator.util.slots import SlotIndex
 from aminator.util.metrics import raises
 
 __all__ = ('LinuxBlockDevicePlugin',)
@@ -56,6 +57,7 @@ class LinuxBlockDevicePlugin(BaseBlockDevicePlugin):
 
         self._allowed_devices = None
         self._device_prefix = None
+        self._slot_index = None
 
     def add_plugin_args(self, *args, **kwargs):
         context = self._config.context
@@ -110,28 +112,67 @@ class LinuxBlockDevicePlugin(BaseBlockDevicePlugin):
         if "block_device" in context.ami:
             return BlockDevice(context.ami.block_device, None)
 
+        if self.plugin_config.get('use_slot_index', False):
+            # the index serializes claims itself
+            return self.find_indexed_dev()
+
         with flock(self._lock_file):
             return self.find_available_dev()
 
+    def _get_slot_index(self):
+        if self._slot_index is None and self.plugin_config.get('use_slot_index', False):
+            self._slot_index = SlotIndex(os.path.join(self._lock_dir, 'slots.sqlite'))
+        return self._slot_index
+
+    def lock_dev(self, dev):
+        device_lock = os.path.join(self._lock_dir, os.path.basename(dev))
+        fh = open(device_lock, 'a')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        log.debug('device {0} locked. fh = {1}'.format(dev, str(fh)))
+        slot_index = self._get_slot_index()
+        if slot_index is not None:
+            slot_index.assign(dev)
+        return BlockDevice(dev, fh)
+
     def release_dev(self, dev):
-        if dev.handle:
+        # the device's slot stays claimed until the volume is detached
+        if dev is not None and dev.handle:
             fcntl.flock(dev.handle, fcntl.LOCK_UN)
             dev.handle.close()
 
+    def detached(self, dev):
+        slot_index = self._get_slot_index()
+        if slot_index is not None:
+            slot_index.release(dev)
+
+    def _present_devices(self):
+        """ device nodes present in /dev, plus the kernel's block devices in /sys/block """
+        present = set()
+        for path in ('/dev', '/sys/block'):
+            try:
+                present.update(os.path.join('/dev', name) for name in os.listdir(path))
+            except OSError:
+                log.debug('Unable to list {0}'.format(path), exc_info=True)
+        return present
+
     @raises("aminator.blockdevice.linux.find_available_dev.error")
     def find_available_dev(self):
         log.info('Searching for an available block device')
         self._setup_allowed_devices()
+        present = self._present_devices()
+        # the instance's attachments are fetched once per pass
+        refresh = True
         for dev in self._allowed_devices:
             log.debug('checking if device {0} is available'.format(dev))
             device_lock = os.path.join(self._lock_dir, os.path.basename(dev))
-            if os.path.exists(dev):
+            if dev in present:
                 log.debug('{0} exists, skipping'.format(dev))
                 continue
             elif locked(device_lock):
                 log.debug('{0} is locked, skipping'.format(dev))
                 continue
-            elif self.cloud.is_stale_attachment(dev, self._device_prefix):
+            elif self.cloud.is_stale_attachment(dev, self._device_prefix, refresh=refresh):
+                refresh = False
                 log.debug('{0} is stale, skipping'.format(dev))
                 continue
             else:
@@ -142,3 +183,42 @@ class LinuxBlockDevicePlugin(BaseBlockDevicePlugin):
                 log.info('Block device {0} allocated'.format(dev))
                 return BlockDevice(dev, fh)
         raise DeviceException('Exhausted all devices, none free')
+
+    @raises("aminator.blockdevice.linux.find_indexed_dev.error")
+    def find_indexed_dev(self):
+        """
+        claim a free slot from the host-wide slot index. the per-device lock files are still
+        taken, so allocators not using the index and deferred cleanups are respected
+        """
+        log.info('Claiming a block device slot')
+        self._setup_allowed_devices()
+        slot_index = self._get_slot_index()
+        skip = self._present_devices()
+        refresh = True
+        while True:
+            dev = slot_index.claim(self._allowed_devices, exclude=skip)
+            if dev is None:
+                raise DeviceException('Exhausted all devices, none free')
+            skip.add(dev)
+            device_lock = os.path.join(self._lock_dir, os.path.basename(dev))
+            fh = open(device_lock, 'a')
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                log.debug('{0} is locked, skipping'.format(dev))
+                fh.close()
+                slot_index.release(dev)
+                continue
+            if self.cloud.is_stale_attachment(dev, self._device_prefix, refresh=refresh):
+                refresh = False
+                log.debug('{0} is stale, skipping'.format(dev))
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+                slot_index.release(dev)
+                continue
+            # attached devices count whether or not a live bake holds their slot
+            occupied = len((set(slot_index.occupied()) | self._present_devices()) & set(self._allowed_devices))
+            self._config.metrics.gauge('aminator.blockdevice.linux.slots.occupied', occupied)
+            self._config.metrics.gauge('aminator.blockdevice.linux.slots.free', len(self._allowed_devices) - occupied)
+            log.info('Block device {0} allocated'.format(dev))
+            return BlockDevice(dev, fh)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.plugins.blockdevice.loop
+=================================
+loop device manager for baking into local image files
+"""
+import fcntl
+import logging
+import os
+
+from aminator.exceptions import DeviceException
+from aminator.plugins.blockdevice.linux import BlockDevice, LinuxBlockDevicePlugin
+from aminator.util.linux import flock, locked, loop_backing_file
+from aminator.util.metrics import raises
+
+__all__ = ('LoopBlockDevicePlugin',)
+log = logging.getLogger(__name__)
+
+
+class LoopBlockDevicePlugin(LinuxBlockDevicePlugin):
+    _name = 'loop'
+
+    def _setup_allowed_devices(self):
+        if self._allowed_devices:
+            return
+        block_config = self._config.plugins[self.full_name]
+        self._device_prefix = 'loop'
+        context = self._config.context
+        if 'partition' in context.ami:
+            self.partition = context.ami.partition
+        self._allowed_devices = ['/dev/loop{0}'.format(minor) for minor in xrange(block_config.get('max_loop_devices', 8))]
+
+    def allocate_dev(self):
+        context = self._config.context
+        if "block_device" in context.ami:
+            return BlockDevice(context.ami.block_device, None)
+
+        with flock(self._lock_file):
+            return self.find_available_dev()
+
+    @raises("aminator.blockdevice.loop.find_available_dev.error")
+    def find_available_dev(self):
+        log.info('Searching for an available loop device')
+        self._setup_allowed_devices()
+        for dev in self._allowed_devices:
+            log.debug('checking if device {0} is available'.format(dev))
+            device_lock = os.path.join(self._lock_dir, os.path.basename(dev))
+            if not os.path.exists(dev):
+                log.debug('{0} does not exist, skipping'.format(dev))
+                continue
+            elif loop_backing_file(dev):
+                log.debug('{0} is attached, skipping'.format(dev))
+                continue
+            elif locked(device_lock):
+                log.debug('{0} is locked, skipping'.format(dev))
+                continue
+            else:
+                fh = open(device_lock, 'a')
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                log.info('Loop device {0} allocated'.format(dev))
+                return BlockDevice(dev, fh)
+        raise DeviceException('Exhausted all loop devices, none free')
@@ -72,24 +72,40 @@ class BaseCloudPlugin(BasePlugin):
         """ volume attachment status """
 
     @abc.abstractmethod
-    def is_stale_attachment(self, dev, prefix):
-        """ checks to see if a given device is a stale attachment """
+    def is_stale_attachment(self, dev, prefix, refresh=True):
+        """
+        checks to see if a given device is a stale attachment. pass refresh=False to reuse
+        the attachments fetched by the previous check
+        """
 
     @abc.abstractmethod
-    def attached_block_devices(self, prefix):
+    def attached_block_devices(self, prefix, refresh=True):
         """
         list any block devices attached to the aminator instance.
-        helps blockdevice plugins allocate an os device node
+        helps blockdevice plugins allocate an os device node.
+        refresh=False returns the last fetched list, if there is one
         """
 
     @abc.abstractmethod
-    def add_tags(self, resource_type):
-        """ consumes tags and applies them to objects """
+    def add_tags(self, resource_types):
+        """ consumes tags and applies them to objects of one or more resource types """
 
     @abc.abstractmethod
     def register_image(self, *args, **kwargs):
         """ Instructs the cloud provider to register a finalized image for launching """
 
+    def reconnect(self):
+        """ drop the connection and establish a fresh one, e.g. in a forked child """
+        self._connection = None
+        self.connect()
+
+    def cleanup_volume(self, volume_id, blockdevice):
+        """
+        detach (if need be) and delete a volume by id, tolerating whatever state an earlier,
+        interrupted cleanup left it in. Used by deferred volume cleanup
+        """
+        raise NotImplementedError('{0} does not support volume cleanup by id'.format(self.full_name))
+
     def __enter__(self):
         self.connect()
         return self
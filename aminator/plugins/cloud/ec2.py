@@ -24,32 +24,42 @@ aminator.plugins.cloud.ec2
 ec2 cloud provider
 """
 import logging
-from time import sleep
+import threading
+from datetime import datetime
+from time import sleep, time
 
 from boto.ec2 import connect_to_region, EC2Connection
 from boto.ec2.image import Image
 from boto.ec2.instance import Instance
 from boto.ec2.volume import Volume
-from boto.exception import EC2ResponseError
-from boto.utils import get_instance_metadata
-from botocore.exceptions import ClientError
+from boto import config as boto_config
+from boto.exception import BotoServerError, EC2ResponseError, PleaseRetryException
+from boto.utils import parse_ts
+from botocore.config import Config as BotocoreConfig
+from botocore.exceptions import ClientError, WaiterError
 from decorator import decorator
 from os import environ
 import boto3
 import os.path
-import dill
 
 from aminator.config import conf_action
 from aminator.exceptions import FinalizerException, VolumeException
 from aminator.plugins.cloud.base import BaseCloudPlugin
 from aminator.util import retry
-from aminator.util.linux import device_prefix, native_block_device, os_node_exists, mkdir_p
+from aminator.util.ec2 import ImageCache, ResourceWaiter, image_record, instance_identity, resource_state
+from aminator.util.linux import device_prefix, native_block_device, os_node_exists, flock, wait_for_node
+from aminator.util.ratelimit import RateLimiter, THROTTLING_CODES, api_class
 from aminator.util.metrics import timer, raises, succeeds, lapse
 
 
 __all__ = ('EC2CloudPlugin',)
 log = logging.getLogger(__name__)
 
+# tag identifying spare base volumes kept ready by the volume pool
+VOLUME_POOL_TAG = 'aminator-pool'
+# attach errors meaning another instance claimed, or a sweep deleted, a pooled volume first
+POOL_CLAIM_LOST = ('IncorrectState', 'InvalidVolume.NotFound', 'VolumeInUse')
+
 
 def registration_retry(ExceptionToCheck=(ClientError,), tries=3, delay=1, backoff=1, logger=None):
     """
@@ -87,7 +97,11 @@ class EC2CloudPlugin(BaseCloudPlugin):
     _name = 'ec2'
 
     def add_metrics(self, metric_base_name, cls, func_name):
+        # the wrapping patches boto's classes, which every ec2 plugin loaded (ec2_local too) shares
+        if getattr(getattr(cls, func_name), 'metrics_wrapped', False):
+            return
         newfunc = succeeds("{0}.count".format(metric_base_name), self)(raises("{0}.error".format(metric_base_name), self)(timer("{0}.duration".format(metric_base_name), self)(getattr(cls, func_name))))
+        newfunc.metrics_wrapped = True
         setattr(cls, func_name, newfunc)
 
     def __init__(self):
@@ -149,9 +163,14 @@ class EC2CloudPlugin(BaseCloudPlugin):
         super(EC2CloudPlugin, self).configure(config, parser)
         host = config.context.web_log.get('host', False)
         if not host:
-            md = get_instance_metadata()
-            pub, ipv4 = 'public-hostname', 'local-ipv4'
-            config.context.web_log['host'] = md[pub] if pub in md else md[ipv4]
+            identity = self._instance_identity()
+            config.context.web_log['host'] = identity.public_hostname or identity.local_ipv4
+
+    def _instance_identity(self, refresh=False):
+        cloud_config = self._config.plugins[self.full_name]
+        return instance_identity(refresh=refresh,
+                                 timeout=cloud_config.get('metadata_timeout', None),
+                                 num_retries=cloud_config.get('metadata_retries', 5))
 
     def connect(self, **kwargs):
         if self._connection:
@@ -163,8 +182,7 @@ class EC2CloudPlugin(BaseCloudPlugin):
     def _connect(self, **kwargs):
         cloud_config = self._config.plugins[self.full_name]
         context = self._config.context
-        self._instance_metadata = get_instance_metadata()
-        instance_region = self._instance_metadata['placement']['availability-zone'][:-1]
+        instance_region = self._instance_identity().region
         region = kwargs.pop('region', context.get('region', cloud_config.get('region', instance_region)))
         log.debug('Establishing connection to region: {0}'.format(region))
 
@@ -179,14 +197,124 @@ class EC2CloudPlugin(BaseCloudPlugin):
         if 'is_secure' not in kwargs:
             kwargs['is_secure'] = context.get('is_secure', cloud_config.get('is_secure', True))
         self._connection = connect_to_region(region, **kwargs)
+        self._region = region
+        self._rate_limiters = {}
+        limiter = self._rate_limiter(region)
+        if limiter is not None:
+            self._limit_connection(self._connection, limiter)
+        self._boto3_session = boto3.session.Session(region_name=region)
+        self._boto3_config = BotocoreConfig(max_pool_connections=cloud_config.get('boto3_max_pool_connections', 10))
+        self._boto3_clients = {}
+        self._boto3_lock = threading.Lock()
+        self._waiter = ResourceWaiter(
+            self._connection, cloud_config.get('state_poll_interval', 1),
+            snapshot_floor=cloud_config.get('snapshot_poll_floor', 1),
+            snapshot_ceiling=cloud_config.get('snapshot_poll_ceiling', 30),
+            eta_callback=self._snapshot_eta)
         log.info('Aminating in region {0}'.format(region))
 
+    def _ec2_client(self, region=None):
+        """
+        long-lived boto3 ec2 clients, one per region, created from a single session so
+        credentials, service models and keep-alive connections are shared across calls
+        """
+        region = region or self._region
+        # boto3 sessions are not thread safe, clients are
+        with self._boto3_lock:
+            if region not in self._boto3_clients:
+                log.debug('Creating boto3 ec2 client for region {0}'.format(region))
+                client = self._boto3_session.client('ec2', region_name=region, config=self._boto3_config)
+                limiter = self._rate_limiter(region)
+                if limiter is not None:
+                    self._limit_client(client, limiter)
+                self._boto3_clients[region] = client
+            return self._boto3_clients[region]
+
+    def _rate_limiter(self, region):
+        """
+        the host-wide limiter for a region, shared with every other aminator process through
+        state files under aminator_root. None unless rate_limit is enabled
+        """
+        cloud_config = self._config.plugins[self.full_name]
+        if not cloud_config.get('rate_limit', False):
+            return None
+        if region not in self._rate_limiters:
+            state_dir = cloud_config.get('rate_limit_dir', 'ratelimit')
+            if not state_dir.startswith(('/', '~')):
+                state_dir = os.path.join(self._config.aminator_root, state_dir)
+            self._rate_limiters[region] = RateLimiter(
+                os.path.expanduser(state_dir), region, cloud_config.rate_limit_budgets,
+                increase=cloud_config.get('rate_limit_increase', 0.1),
+                decrease=cloud_config.get('rate_limit_decrease', 0.5))
+        return self._rate_limiters[region]
+
+    def _throttled(self, limiter, action):
+        """ record a throttled request, returns whether the limiter paces action's retries """
+        limiter.throttled(action)
+        self._config.metrics.increment('aminator.cloud.ec2.throttled.{0}'.format(api_class(action)))
+        bucket = limiter.bucket(action)
+        if bucket is None:
+            return False
+        self._config.metrics.gauge('aminator.cloud.ec2.rate_limit.{0}'.format(api_class(action)), bucket.rate())
+        return True
+
+    def _limit_connection(self, connection, limiter):
+        """
+        route every boto request made through connection, retries included, via the limiter.
+        boto's own retries would resend throttled requests behind the limiter's back, so they
+        are turned off and redone here, for the same errors boto retries
+        """
+        make_request = connection.make_request
+        mexe = connection._mexe
+        tries = boto_config.getint('Boto', 'num_retries', connection.num_retries) + 1
+        connection.num_retries = 0
+        retryable = (PleaseRetryException,) + tuple(connection.http_exceptions)
+        unretryable = tuple(connection.http_unretryable_exceptions)
+
+        def single_attempt(request, sender=None, override_num_retries=None, retry_handler=None):
+            # a num_retries from the boto config file would win over the attribute
+            return mexe(request, sender, 0, retry_handler)
+
+        def limited_request(action, *args, **kwargs):
+            for attempt in xrange(tries):
+                limiter.acquire(action)
+                paced = False
+                try:
+                    return make_request(action, *args, **kwargs)
+                except BotoServerError as e:
+                    if e.error_code in THROTTLING_CODES:
+                        paced = self._throttled(limiter, action)
+                    elif int(e.status or 0) < 500:
+                        raise
+                    if attempt == tries - 1:
+                        raise
+                    log.debug('{0} failed: {1} {2}, retrying'.format(action, e.status, e.error_code))
+                except retryable as e:
+                    if isinstance(e, unretryable) or attempt == tries - 1:
+                        raise
+                    log.debug('{0} failed: {1!r}, retrying'.format(action, e))
+                if not paced:
+                    # throttled retries are paced by the limiter, if it has a bucket for the action
+                    sleep(min(2 ** attempt, 20))
+        connection._mexe = single_attempt
+        connection.make_request = limited_request
+
+    def _limit_client(self, client, limiter):
+        """ route every request a boto3 client sends, retries included, via the limiter """
+        def before_send(event_name=None, **kwargs):
+            limiter.acquire(event_name.rsplit('.', 1)[-1])
+
+        def needs_retry(event_name=None, response=None, **kwargs):
+            if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_CODES:
+                self._throttled(limiter, event_name.rsplit('.', 1)[-1])
+
+        client.meta.events.register('before-send.ec2', before_send)
+        client.meta.events.register('needs-retry.ec2', needs_retry)
+
     def allocate_base_volume(self, tag=True):
         cloud_config = self._config.plugins[self.full_name]
         context = self._config.context
 
-        self._volume = Volume(connection=self._connection)
-
         rootdev = context.base_ami.block_device_mapping[context.base_ami.root_device_name]
         volume_type = context.cloud.get('provisioner_ebs_type', cloud_config.get('provisioner_ebs_type', 'standard'))
         volume_size = context.ami.get('root_volume_size', None)
@@ -201,13 +329,11 @@ class EC2CloudPlugin(BaseCloudPlugin):
             raise VolumeException(
                 'root_volume_size ({}) must be at least as large as the root '
                 'volume of the base AMI ({})'.format(volume_size, rootdev.size))
-        self._volume.id = self._connection.create_volume(
-            size=volume_size, zone=self._instance.placement,
-            volume_type=volume_type, snapshot=rootdev.snapshot_id).id
-        if not self._volume_available():
-            log.critical('{0}: unavailable.')
-            return False
+        # lets the volume plugin skip resizing when the geometry is unchanged
+        context.volume['size'] = volume_size * 1024 ** 3
+        context.volume['base_size'] = rootdev.size * 1024 ** 3
 
+        tags = None
         if tag:
             tags = {
                 'purpose': cloud_config.get('tag_ami_purpose', 'amination'),
@@ -216,9 +342,174 @@ class EC2CloudPlugin(BaseCloudPlugin):
                 'ami-name': context.base_ami.name,
                 'arch': context.base_ami.architecture,
             }
-            self._connection.create_tags([self._volume.id], tags)
-        self._volume.update()
+
+        self._pooled = False
+        self._pool_spares = []
+        self._volume_spec = (volume_size, volume_type, rootdev.snapshot_id, tags)
+        pool_size = int(cloud_config.get('volume_pool_size', 0) or 0)
+        if pool_size > 0:
+            pool_key = '{0}:{1}:{2}'.format(rootdev.snapshot_id, volume_size, volume_type)
+            self._pool_claim = dict(tags or {'status': 'claimed'})
+            self._pool_claim['claimed-by'] = self._instance.id
+            self._pool_spares = self._pool_candidates(pool_key)
+            self._refill_volume_pool(pool_key, pool_size, volume_size, volume_type, rootdev.snapshot_id)
+
+        if self._pool_spares:
+            self._pooled = True
+            self._volume = self._pool_spares.pop(0)
+            log.debug('Trying pooled volume {0}'.format(self._volume.id))
+            return True
+        if pool_size > 0:
+            self._config.metrics.increment('aminator.cloud.ec2.volume_pool.miss')
+        return self._new_base_volume()
+
+    def _new_base_volume(self):
+        self._pooled = False
+        volume_size, volume_type, snapshot_id, tags = self._volume_spec
+        self._volume = Volume(connection=self._connection)
+        self._volume.id = self._create_volume(volume_size, volume_type, snapshot_id, tags)
+        if not self._volume_available():
+            log.critical('{0}: unavailable.')
+            return False
         log.debug('Volume {0} created'.format(self._volume.id))
+        return True
+
+    def _create_volume(self, volume_size, volume_type, snapshot_id=None, tags=None):
+        """ create a volume, empty or from a snapshot, applying tags in the same CreateVolume request """
+        kwargs = {}
+        if tags:
+            kwargs['TagSpecifications'] = [{
+                'ResourceType': 'volume',
+                'Tags': [{'Key': key, 'Value': str(value)} for (key, value) in tags.iteritems()],
+            }]
+        metric_base = 'aminator.cloud.ec2.connection.create_volume'
+        start = time()
+        try:
+            if snapshot_id:
+                kwargs['SnapshotId'] = snapshot_id
+            response = self._ec2_client().create_volume(
+                Size=volume_size, AvailabilityZone=self._instance.placement,
+                VolumeType=volume_type, **kwargs)
+        except ClientError as e:
+            self._config.metrics.increment('{0}.error'.format(metric_base))
+            raise VolumeException('Error creating volume: {0}'.format(e))
+        finally:
+            self._config.metrics.timer('{0}.duration'.format(metric_base), time() - start)
+        self._config.metrics.increment('{0}.count'.format(metric_base))
+        return response['VolumeId']
+
+    def _volume_pool_lock(self, name):
+        if self._config.lock_dir.startswith(('/', '~')):
+            lock_dir = os.path.expanduser(self._config.lock_dir)
+        else:
+            lock_dir = os.path.join(self._config.aminator_root, self._config.lock_dir)
+        return os.path.join(lock_dir, 'volume-pool.{0}'.format(name))
+
+    def _pooled_volumes(self, pool_key, states):
+        filters = {
+            'tag:{0}'.format(VOLUME_POOL_TAG): pool_key,
+            'tag:status': 'pooled',
+            'availability-zone': self._instance.placement,
+            'status': states,
+        }
+        return self._connection.get_all_volumes(filters=filters)
+
+    def _pool_candidates(self, pool_key):
+        """ the available volumes of the pool, none of them claimed until attached """
+        try:
+            return self._pooled_volumes(pool_key, ['available'])
+        except EC2ResponseError:
+            log.warn('Unable to list pooled volumes for {0}'.format(pool_key))
+            log.debug('Unable to list pooled volumes for {0}'.format(pool_key), exc_info=True)
+            return []
+
+    def _attach_base_volume(self, ec2_device_name):
+        """
+        attach the allocated volume. a pooled volume is claimed by the attach itself, which
+        only one instance can win: one attached elsewhere first is passed over for the next
+        spare, and a new volume is created once the spares run out
+        """
+        while self._pooled:
+            try:
+                self._volume.attach(self._instance.id, ec2_device_name)
+            except EC2ResponseError as e:
+                if e.error_code not in POOL_CLAIM_LOST:
+                    raise
+                log.debug('Pooled volume {0} was claimed elsewhere ({1}), skipping'.format(self._volume.id, e.error_code))
+                if self._pool_spares:
+                    self._volume = self._pool_spares.pop(0)
+                    continue
+                self._config.metrics.increment('aminator.cloud.ec2.volume_pool.miss')
+                if not self._new_base_volume():
+                    raise VolumeException('Volume {0} did not become available'.format(self._volume.id))
+                break
+            log.info('Using pooled volume {0}'.format(self._volume.id))
+            self._config.metrics.increment('aminator.cloud.ec2.volume_pool.hit')
+            try:
+                self._connection.create_tags([self._volume.id], self._pool_claim)
+            except EC2ResponseError:
+                log.warn('Unable to tag claimed volume {0}'.format(self._volume.id))
+                log.debug('Unable to tag claimed volume {0}'.format(self._volume.id), exc_info=True)
+            return
+        self._volume.attach(self._instance.id, ec2_device_name)
+
+    def _refill_volume_pool(self, pool_key, pool_size, volume_size, volume_type, snapshot_id):
+        refill = threading.Thread(target=self._fill_volume_pool, name='volume-pool-refill',
+                                  args=(pool_key, pool_size, volume_size, volume_type, snapshot_id))
+        refill.daemon = True
+        refill.start()
+        self._pool_refills.append(refill)
+
+    def _fill_volume_pool(self, pool_key, pool_size, volume_size, volume_type, snapshot_id):
+        cloud_config = self._config.plugins[self.full_name]
+        context = self._config.context
+        try:
+            with flock(self._volume_pool_lock('refill')):
+                max_age = cloud_config.get('volume_pool_max_age', 86400)
+                if max_age:
+                    self._sweep_volume_pools(max_age)
+                spares = len(self._pooled_volumes(pool_key, ['creating', 'available']))
+                tags = {
+                    'purpose': cloud_config.get('tag_ami_purpose', 'amination'),
+                    'status': 'pooled',
+                    VOLUME_POOL_TAG: pool_key,
+                    'ami': context.base_ami.id,
+                    'ami-name': context.base_ami.name,
+                    'arch': context.base_ami.architecture,
+                }
+                for _ in xrange(pool_size - spares):
+                    # tagged on creation, so a refill cut short never leaves an unaccounted volume
+                    volume_id = self._create_volume(volume_size, volume_type, snapshot_id=snapshot_id, tags=tags)
+                    log.debug('Added volume {0} to pool {1}'.format(volume_id, pool_key))
+        except Exception:
+            errstr = 'Error refilling volume pool {0}'.format(pool_key)
+            log.warn(errstr)
+            log.debug(errstr, exc_info=True)
+
+    def _sweep_volume_pools(self, max_age):
+        """
+        delete the spares of every pool in this availability zone that went unclaimed for
+        max_age seconds, so pools of base AMIs no longer baked on don't linger
+        """
+        filters = {
+            'tag-key': VOLUME_POOL_TAG,
+            'tag:status': 'pooled',
+            'availability-zone': self._instance.placement,
+            'status': 'available',
+        }
+        now = datetime.utcnow()
+        for volume in self._connection.get_all_volumes(filters=filters):
+            age = (now - parse_ts(volume.create_time)).total_seconds()
+            if age < max_age:
+                continue
+            log.debug('Deleting volume {0} unclaimed in pool {1} for {2:.0f}s'.format(volume.id, volume.tags.get(VOLUME_POOL_TAG), age))
+            try:
+                # one attached in the meantime is refused as in use
+                volume.delete()
+            except EC2ResponseError:
+                log.debug('Unable to delete pooled volume {0}'.format(volume.id), exc_info=True)
+                continue
+            self._config.metrics.increment('aminator.cloud.ec2.volume_pool.expired')
 
     @retry(VolumeException, tries=2, delay=1, backoff=2, logger=log)
     def attach_volume(self, blockdevice, tag=True):
@@ -235,12 +526,13 @@ class EC2CloudPlugin(BaseCloudPlugin):
         # must do this as amazon still wants /dev/sd*
         ec2_device_name = blockdevice.replace('xvd', 'sd')
         log.debug('Attaching volume {0} to {1}:{2}({3})'.format(self._volume.id, self._instance.id, ec2_device_name, blockdevice))
-        self._volume.attach(self._instance.id, ec2_device_name)
+        self._attach_base_volume(ec2_device_name)
         if not self.is_volume_attached(blockdevice):
             log.debug('{0} attachment to {1}:{2}({3}) timed out'.format(self._volume.id, self._instance.id, ec2_device_name, blockdevice))
             self._volume.add_tag('status', 'used')
             # trigger a retry
             raise VolumeException('Timed out waiting for {0} to attach to {1}:{2}'.format(self._volume.id, self._instance.id, blockdevice))
+        context.volume['id'] = self._volume.id
         log.debug('Volume {0} attached to {1}:{2}'.format(self._volume.id, self._instance.id, blockdevice))
 
     def is_volume_attached(self, blockdevice):
@@ -248,6 +540,9 @@ class EC2CloudPlugin(BaseCloudPlugin):
         if "volume_id" in context.ami:
             return True
 
+        device_timeout = self.plugin_config.get('device_event_timeout', 30)
+        if not wait_for_node(blockdevice, exists=True, timeout=device_timeout):
+            log.debug('{0} did not appear within {1}s, polling'.format(blockdevice, device_timeout))
         try:
             self._volume_attached(blockdevice)
         except VolumeException:
@@ -265,12 +560,15 @@ class EC2CloudPlugin(BaseCloudPlugin):
         else:
             return True
 
-    def snapshot_volume(self, description=None):
+    def snapshot_volume(self, description=None, wait=True):
         context = self._config.context
         if not description:
             description = context.snapshot.get('description', '')
         log.debug('Creating snapshot with description {0}'.format(description))
         self._snapshot = self._volume.create_snapshot(description)
+        if not wait:
+            log.debug('Snapshot started. id: {0}'.format(self._snapshot.id))
+            return True
         if not self._snapshot_complete():
             log.critical('Failed to create snapshot')
             return False
@@ -278,23 +576,15 @@ class EC2CloudPlugin(BaseCloudPlugin):
             log.debug('Snapshot complete. id: {0}'.format(self._snapshot.id))
             return True
 
-    def _state_check(self, obj, state):
-        obj.update()
-        classname = obj.__class__.__name__
-        if classname in ('Snapshot', 'Volume'):
-            if classname == 'Snapshot':
-                log.debug("Snapshot {0} state: {1}, progress: {2}".format(obj.id, obj.status, obj.progress))
-            return obj.status == state
-        else:
-            return obj.state == state
-
-    @retry(VolumeException, tries=600, delay=0.5, backoff=1.5, logger=log, maxdelay=10)
     def _wait_for_state(self, resource, state):
-        if self._state_check(resource, state):
-            log.debug('{0} reached state {1}'.format(resource.__class__.__name__, state))
-            return True
-        else:
-            raise VolumeException('Timed out waiting for {0} to get to {1}({2})'.format(resource.id, state, resource.status))
+        timeout = self.plugin_config.get('state_wait_timeout', 6000)
+        if not self._waiter.wait(resource, state, timeout):
+            raise VolumeException('Timed out waiting for {0} to get to {1}({2})'.format(resource.id, state, resource_state(resource)))
+        log.debug('{0} reached state {1}'.format(resource.__class__.__name__, state))
+        return True
+
+    def _snapshot_eta(self, snapshot, seconds):
+        self._config.metrics.gauge('aminator.cloud.ec2.snapshot_completed.eta', seconds)
 
     @lapse("aminator.cloud.ec2.ami_available.duration")
     def _ami_available(self):
@@ -315,6 +605,9 @@ class EC2CloudPlugin(BaseCloudPlugin):
 
         log.debug('Detaching volume {0} from {1}'.format(self._volume.id, self._instance.id))
         self._volume.detach()
+        device_timeout = self.plugin_config.get('device_event_timeout', 30)
+        if not wait_for_node(blockdevice, exists=False, timeout=device_timeout):
+            log.debug('{0} still present after {1}s, polling'.format(blockdevice, device_timeout))
         if not self._volume_detached(blockdevice):
             raise VolumeException('Time out waiting for {0} to detach from {1}'.format(self._volume.id, self._instance.id))
         log.debug('Successfully detached volume {0} from {1}'.format(self._volume.id, self._instance.id))
@@ -342,9 +635,30 @@ class EC2CloudPlugin(BaseCloudPlugin):
             log.debug('Volume {0} successfully deleted'.format(self._volume.id))
         return result
 
-    def is_stale_attachment(self, dev, prefix):
+    def cleanup_volume(self, volume_id, blockdevice):
+        volumes = self._connection.get_all_volumes(filters={'volume-id': [volume_id]})
+        if not volumes:
+            log.debug('Volume {0} no longer exists'.format(volume_id))
+            return True
+        volume = volumes[0]
+        instance_id = volume.attach_data.instance_id
+        if instance_id:
+            if instance_id != self._instance_identity().instance_id:
+                log.warn('Volume {0} is attached to {1}, not cleaning up'.format(volume_id, instance_id))
+                return False
+            log.debug('Detaching volume {0} from {1}'.format(volume_id, instance_id))
+            volume.detach()
+        if volume.status != 'available':
+            self._wait_for_state(volume, 'available')
+        log.debug('Deleting volume {0}'.format(volume_id))
+        if not volume.delete():
+            raise VolumeException('Volume {0} delete returned False'.format(volume_id))
+        log.debug('Volume {0} successfully deleted'.format(volume_id))
+        return True
+
+    def is_stale_attachment(self, dev, prefix, refresh=True):
         log.debug('Checking for stale attachment. dev: {0}, prefix: {1}'.format(dev, prefix))
-        if dev in self.attached_block_devices(prefix) and not os_node_exists(dev):
+        if dev in self.attached_block_devices(prefix, refresh=refresh) and not os_node_exists(dev):
             log.debug('{0} is stale, rejecting'.format(dev))
             return True
         log.debug('{0} not stale, using'.format(dev))
@@ -352,8 +666,7 @@ class EC2CloudPlugin(BaseCloudPlugin):
 
     @registration_retry(tries=3, delay=1, backoff=1)
     def _register_image(self, **ami_metadata):
-        """Register the AMI using boto3/botocore components which supports ENA
-           This is the only use of boto3 in aminator currently"""
+        """Register the AMI using boto3/botocore components which supports ENA"""
 
         # construct AMI registration payload boto3 style
         request = {}
@@ -391,7 +704,7 @@ class EC2CloudPlugin(BaseCloudPlugin):
         log.debug('Boto3 registration request data [{}]'.format(request))
 
         try:
-            client = boto3.client('ec2', region_name=ami_metadata.get('region'))
+            client = self._ec2_client(ami_metadata.get('region'))
             response = client.register_image(**request)
             log.debug('Registration response data [{}]'.format(response))
 
@@ -399,24 +712,18 @@ class EC2CloudPlugin(BaseCloudPlugin):
             if ami_id is None:
                 return False
 
-            log.info('Waiting for [{}] to become available'.format(ami_id))
-            waiter = client.get_waiter('image_available')
-            wait_request = {}
-            wait_request['ImageIds'] = []
-            wait_request['ImageIds'].append(ami_id)
-            waiter.wait(**wait_request)
-            # Now, using boto2, load the Image so downstream tagging operations work
-            # using boto2 classes
-            log.debug('Image available!  Loading boto2.Image for [{}]'.format(ami_id))
-            self._ami = self._connection.get_image(ami_id)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'InvalidAMIID.NotFound':
-                log.debug('{0} was not found while waiting for it to become available'.format(ami_id))
-                log.error('Error during register_image: {}'.format(e))
-                return False
-            else:
-                # defer to registration_retry decorator
-                raise e
+            # downstream tagging operations work with boto2 classes
+            self._ami = Image(connection=self._connection)
+            self._ami.id = ami_id
+            self._ami.name = request['Name']
+            if ami_metadata.get('wait', True):
+                log.info('Waiting for [{}] to become available'.format(ami_id))
+                self._ami_available()
+        except VolumeException as e:
+            # never available, or not found before the wait timed out. a ClientError from
+            # registering is left to the registration_retry decorator
+            log.error('Error during register_image: {}'.format(e))
+            return False
 
         log.info('AMI registered: {0} {1}'.format(self._ami.id, self._ami.name))
         self._config.context.ami.image = self._ami
@@ -428,8 +735,7 @@ class EC2CloudPlugin(BaseCloudPlugin):
         vm_type = context.ami.get("vm_type", "paravirtual")
         architecture = context.ami.get("architecture", "x86_64")
         cloud_config = self._config.plugins[self.full_name]
-        self._instance_metadata = get_instance_metadata()
-        instance_region = self._instance_metadata['placement']['availability-zone'][:-1]
+        instance_region = self._instance_identity().region
         region = kwargs.pop('region', context.get('region', cloud_config.get('region', instance_region)))
 
         ami_metadata = {
@@ -460,11 +766,69 @@ class EC2CloudPlugin(BaseCloudPlugin):
                 ami_metadata['sriov_net_support'] = 'simple'
             ami_metadata['ena_networking'] = context.ami.get('ena_networking', False)
 
+        ami_metadata['wait'] = kwargs.get('wait', True)
+
         if not self._register_image(**ami_metadata):
             return False
 
         return True
 
+    def wait_for_image(self):
+        """ wait for an image registered with wait=False to become available """
+        log.info('Waiting for [{}] to become available'.format(self._ami.id))
+        try:
+            return self._ami_available()
+        except VolumeException as e:
+            log.error('Error waiting for image: {}'.format(e))
+            return False
+
+    def copy_image(self, regions):
+        """
+        copy the registered AMI to each region concurrently, tag the copies and wait for
+        all of them to become available. the resulting ids land in context.ami.copies
+        """
+        context = self._config.context
+        copies = {}
+        workers = [threading.Thread(target=self._copy_image, args=(region, copies), name='copy-image-{0}'.format(region))
+                   for region in regions]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        context.ami.copies = dict((region, ami_id) for (region, ami_id) in copies.iteritems() if ami_id)
+        return all(copies.get(region) for region in regions)
+
+    def _copy_image(self, region, copies):
+        context = self._config.context
+        cloud_config = self._config.plugins[self.full_name]
+        metric_base = 'aminator.cloud.ec2.copy_image.{0}'.format(region)
+        start = time()
+        ami_id = None
+        try:
+            client = self._ec2_client(region)
+            response = client.copy_image(SourceRegion=self._region, SourceImageId=self._ami.id,
+                                         Name=context.ami.name, Description=context.ami.description)
+            ami_id = response['ImageId']
+            log.info('Copying {0} to {1} as {2}'.format(self._ami.id, region, ami_id))
+            tags = [{'Key': key, 'Value': str(value)} for (key, value) in context.ami.tags.iteritems()]
+            if tags:
+                client.create_tags(Resources=[ami_id], Tags=tags)
+            waiter = client.get_waiter('image_available')
+            waiter.wait(ImageIds=[ami_id], WaiterConfig={
+                'Delay': cloud_config.get('copy_image_poll_interval', 15),
+                'MaxAttempts': cloud_config.get('copy_image_max_attempts', 240)})
+        except (ClientError, WaiterError):
+            errstr = 'Error copying {0} to {1}'.format(self._ami.id, region)
+            log.critical(errstr)
+            log.debug(errstr, exc_info=True)
+            self._config.metrics.increment('{0}.error'.format(metric_base))
+            copies[region] = None
+            return
+        finally:
+            self._config.metrics.timer('{0}.duration'.format(metric_base), time() - start)
+        log.info('AMI {0} available in {1}'.format(ami_id, region))
+        copies[region] = ami_id
+
     def _make_block_device_map(self, block_device_map, root_block_device, delete_on_termination=True):
         """ construct boto3 style BlockDeviceMapping """
 
@@ -502,45 +866,65 @@ class EC2CloudPlugin(BaseCloudPlugin):
         return bdm
 
     @retry(FinalizerException, tries=3, delay=1, backoff=2, logger=log)
-    def add_tags(self, resource_type):
+    def add_tags(self, resource_types):
+        """
+        tag one or more resource types. resources sharing an identical tag set are tagged
+        with a single CreateTags call
+        """
         context = self._config.context
+        if isinstance(resource_types, basestring):
+            resource_types = [resource_types]
 
-        log.debug('Adding tags for resource type {0}'.format(resource_type))
+        log.debug('Adding tags for resource types {0}'.format(', '.join(resource_types)))
 
-        tags = context[resource_type].get('tags', None)
-        if not tags:
-            log.critical('Unable to locate tags for {0}'.format(resource_type))
-            return False
+        groups = {}
+        for resource_type in resource_types:
+            tags = context[resource_type].get('tags', None)
+            if not tags:
+                log.critical('Unable to locate tags for {0}'.format(resource_type))
+                continue
 
-        instance_var = '_' + resource_type
-        try:
-            instance = getattr(self, instance_var)
-        except Exception:
-            errstr = 'Tagging failed: Unable to find local instance var {0}'.format(instance_var)
-            log.debug(errstr, exc_info=True)
-            log.critical(errstr)
-            return False
-        else:
+            instance_var = '_' + resource_type
+            try:
+                instance = getattr(self, instance_var)
+            except Exception:
+                errstr = 'Tagging failed: Unable to find local instance var {0}'.format(instance_var)
+                log.debug(errstr, exc_info=True)
+                log.critical(errstr)
+                return False
+            key = frozenset((name, str(value)) for (name, value) in tags.iteritems())
+            groups.setdefault(key, []).append((resource_type, instance))
+
+        for key, members in groups.iteritems():
+            tags = dict(key)
+            ids = [member.id for (member_type, member) in members]
             try:
-                self._connection.create_tags([instance.id], tags)
+                self._connection.create_tags(ids, tags)
             except EC2ResponseError:
-                errstr = 'Error creating tags for resource type {0}, id {1}'
-                errstr = errstr.format(resource_type, instance.id)
+                errstr = 'Error creating tags for resource types {0}, ids {1}'
+                errstr = errstr.format(', '.join(member_type for (member_type, member) in members), ', '.join(ids))
                 log.critical(errstr)
                 raise FinalizerException(errstr)
-            else:
+            for resource_type, instance in members:
                 log.debug('Successfully tagged {0}({1})'.format(resource_type, instance.id))
-                instance.update()
-                tagstring = '\n'.join('='.join((key, val)) for (key, val) in tags.iteritems())
-                log.debug('Tags: \n{0}'.format(tagstring))
-                return True
+                if log.isEnabledFor(logging.DEBUG):
+                    instance.update()
+                else:
+                    # what CreateTags just applied, without another round trip
+                    instance.tags.update(tags)
+            tagstring = '\n'.join('='.join((name, val)) for (name, val) in sorted(tags.iteritems()))
+            log.debug('Tags: \n{0}'.format(tagstring))
+        return True
 
-    def attached_block_devices(self, prefix):
+    def attached_block_devices(self, prefix, refresh=True):
         log.debug('Checking for currently attached block devices. prefix: {0}'.format(prefix))
-        self._instance.update()
-        if device_prefix(self._instance.block_device_mapping.keys()[0]) != prefix:
-            return dict((native_block_device(dev, prefix), mapping) for (dev, mapping) in self._instance.block_device_mapping.iteritems())
-        return self._instance.block_device_mapping
+        if refresh or getattr(self, '_block_device_mapping', None) is None:
+            self._instance.update()
+            self._block_device_mapping = dict(self._instance.block_device_mapping)
+        block_device_mapping = self._block_device_mapping
+        if device_prefix(block_device_mapping.keys()[0]) != prefix:
+            return dict((native_block_device(dev, prefix), mapping) for (dev, mapping) in block_device_mapping.iteritems())
+        return block_device_mapping
 
     def _resolve_baseami(self):
         log.info('Resolving base AMI')
@@ -562,47 +946,65 @@ class EC2CloudPlugin(BaseCloudPlugin):
         log.info('Successfully resolved {0.name}({0.id})'.format(baseami))
         context['base_ami'] = baseami
 
+    def _image_cache(self):
+        cloud_config = self._config.plugins[self.full_name]
+        return ImageCache(os.path.join(self._config.aminator_root, 'image-cache.sqlite'),
+                          self._region, ttl=cloud_config.get('image_cache_ttl', 3600))
+
     def _lookup_ami_by_name(self, ami_name):
-        ami_details = self._lookup_image_cache(ami_name)
-        if ami_details:
-            return ami_details
+        cache = self._image_cache()
+        cached = cache.by_name(ami_name)
+        if cached:
+            ami_details, fresh = cached
+            if fresh:
+                log.info('loaded cached ami details for {0}'.format(ami_name))
+                return ami_details
+        prefetch = self.plugin_config.get('image_cache_prefetch', None) or []
+        if ami_name in prefetch:
+            log.info('looking up base AMIs with names {0}'.format(', '.join(prefetch)))
+            # only what this prefetch returned, the cache may still hold a deregistered or renamed image
+            records = [record for record in cache.prefetch(self._connection, prefetch) if record.name == ami_name]
+            if records:
+                return records[0]
+            log.info('base AMI {0} not found by prefetch'.format(ami_name))
         log.info('looking up base AMI with name {0}'.format(ami_name))
-        ami_details = self._connection.get_all_images(filters={'name': ami_name})[0]
-        self._save_image_cache(ami_name, ami_details)
-        return ami_details
+        image = self._connection.get_all_images(filters={'name': ami_name})[0]
+        return self._refresh_image_cache(cache, cached, image)
 
     def _lookup_ami_by_id(self, ami_id):
-        ami_details = self._lookup_image_cache(ami_id)
-        if ami_details:
-            return ami_details
+        cache = self._image_cache()
+        cached = cache.by_id(ami_id)
+        if cached:
+            ami_details, fresh = cached
+            if fresh:
+                log.info('loaded cached ami details for {0}'.format(ami_id))
+                return ami_details
         log.info('looking up base AMI with ID {0}'.format(ami_id))
-        ami_details = self._connection.get_all_images(image_ids=[ami_id])[0]
-        self._save_image_cache(ami_id, ami_details)
-        return ami_details
-
-    def _lookup_image_cache(self, filename):
-        cache_file = os.path.join(self._config.aminator_root, "image-cache", filename)
-        if os.path.isfile(cache_file):
-            try:
-                log.info("loading cached ami details for {0}".format(filename))
-                with open(cache_file, 'r') as f:
-                    return dill.load(f)
-            except Exception as e:
-                log.warning("Failed to parse {0}: {1}".format(cache_file, e))
-        return None
-
-    def _save_image_cache(self, filename, details):
-        cache_dir = os.path.join(self._config.aminator_root, "image-cache")
-        cache_file = os.path.join(cache_dir, filename)
-        mkdir_p(cache_dir)
-        with open(cache_file, 'w') as f:
-            dill.dump(details, f)
+        image = self._connection.get_all_images(image_ids=[ami_id])[0]
+        return self._refresh_image_cache(cache, cached, image)
+
+    def _refresh_image_cache(self, cache, cached, image):
+        """
+        a stale entry whose id and freshness tags still match the image just described is kept
+        and its age reset, otherwise the entry is replaced
+        """
+        record = image_record(image)
+        if cached:
+            ami_details = cached[0]
+            freshness_tags = self.plugin_config.get('image_cache_freshness_tags', None) or []
+            if ami_details.id == record['id'] and all(ami_details.tags.get(tag) == record['tags'].get(tag) for tag in freshness_tags):
+                log.debug('cached ami details for {0} still current'.format(ami_details.id))
+                cache.touch(ami_details.id)
+                return ami_details
+            log.info('base AMI {0} changed from {1} to {2}'.format(record['name'], ami_details.id, record['id']))
+        return cache.put([record])[0]
 
     def __enter__(self):
+        self._pool_refills = []
         self.connect()
         self._resolve_baseami()
         self._instance = Instance(connection=self._connection)
-        self._instance.id = get_instance_metadata()['instance-id']
+        self._instance.id = self._instance_identity().instance_id
         self._instance.update()
 
         context = self._config.context
@@ -615,3 +1017,9 @@ class EC2CloudPlugin(BaseCloudPlugin):
             environ["AMINATOR_REGION"] = context.cloud.region
 
         return self
+
+    def __exit__(self, typ, val, trc):
+        for refill in getattr(self, '_pool_refills', []):
+            log.debug('Waiting for volume pool refill to finish')
+            refill.join(self.plugin_config.get('volume_pool_refill_timeout', 120))
+        return super(EC2CloudPlugin, self).__exit__(typ, val, trc)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.plugins.cloud.ec2_local
+================================
+ec2 cloud provider baking on local clones of hydrated base images
+"""
+import fcntl
+import logging
+import os
+from contextlib import contextmanager
+from time import time
+
+from boto.ec2.volume import Volume
+
+from aminator.config import PluginConfig
+from aminator.exceptions import VolumeException
+from aminator.plugins.cloud.ec2 import EC2CloudPlugin
+from aminator.util.linux import (block_copy, device_size, flock, locked, losetup, losetup_detach, loop_backing_file,
+                                 mkdir_p, native_device_prefix, os_node_exists, sparse_copy)
+
+__all__ = ('EC2LocalCloudPlugin',)
+log = logging.getLogger(__name__)
+
+
+class EC2LocalCloudPlugin(EC2CloudPlugin):
+    """
+    Keeps a fully hydrated copy of each base AMI's root volume on local storage and bakes on
+    a reflink clone of it attached through a loop device, so provisioning never waits on EBS
+    lazy loading. The result is written back to a new EBS volume when the snapshot is taken.
+    Use with the loop blockdevice plugin.
+    """
+    _name = 'ec2_local'
+
+    def load_plugin_config(self):
+        super(EC2LocalCloudPlugin, self).load_plugin_config()
+        # everything not set for ec2_local falls back to the ec2 plugin's defaults
+        key = self.full_name
+        ec2_defaults = PluginConfig.from_defaults(self.entry_point, EC2CloudPlugin._name)
+        self._config.plugins[key] = PluginConfig.dict_merge(ec2_defaults, self._config.plugins[key])
+
+    def _local_path(self, key, default):
+        path = self.plugin_config.get(key, default)
+        if path.startswith(('/', '~')):
+            path = os.path.expanduser(path)
+        else:
+            path = os.path.join(self._config.aminator_root, path)
+        mkdir_p(path)
+        return path
+
+    def _lock_path(self, name):
+        if self._config.lock_dir.startswith(('/', '~')):
+            lock_dir = os.path.expanduser(self._config.lock_dir)
+        else:
+            lock_dir = os.path.join(self._config.aminator_root, self._config.lock_dir)
+        return os.path.join(lock_dir, name)
+
+    @contextmanager
+    def _ebs_device(self):
+        """ an unused EBS device name, locked for the duration like the linux blockdevice plugin does """
+        prefix = native_device_prefix(self.plugin_config.get('ebs_device_prefixes', ['xvd', 'sd']))
+        with flock(self._lock_path('EC2LocalCloudPlugin')):
+            for letter in self.plugin_config.get('ebs_device_letters', 'zyxwv'):
+                dev = '/dev/{0}{1}'.format(prefix, letter)
+                device_lock = self._lock_path(os.path.basename(dev))
+                if os_node_exists(dev) or locked(device_lock):
+                    continue
+                if self.is_stale_attachment(dev, prefix):
+                    continue
+                fh = open(device_lock, 'a')
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                break
+            else:
+                raise VolumeException('No free device to attach EBS volumes to')
+        try:
+            yield dev
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+            fh.close()
+
+    def _attach_ebs(self, dev, volume_size, snapshot_id=None):
+        """ create a volume, empty or from snapshot_id, and attach it to dev as self._volume """
+        cloud_config = self._config.plugins[self.full_name]
+        context = self._config.context
+        volume_type = context.cloud.get('provisioner_ebs_type', cloud_config.get('provisioner_ebs_type', 'standard'))
+        self._volume = Volume(connection=self._connection)
+        self._volume.id = self._create_volume(volume_size, volume_type, snapshot_id, tags={
+            'purpose': cloud_config.get('tag_ami_purpose', 'amination'),
+            'status': 'busy',
+            'ami': context.base_ami.id,
+            'ami-name': context.base_ami.name,
+            'arch': context.base_ami.architecture,
+        })
+        if not self._volume_available():
+            raise VolumeException('{0}: unavailable'.format(self._volume.id))
+        log.debug('Attaching volume {0} to {1}'.format(self._volume.id, dev))
+        self._volume.attach(self._instance.id, dev.replace('xvd', 'sd'))
+        if not super(EC2LocalCloudPlugin, self).is_volume_attached(dev):
+            raise VolumeException('Timed out waiting for {0} to attach to {1}'.format(self._volume.id, dev))
+
+    def _golden_image(self):
+        """ the local copy of the base AMI's root volume, hydrated from EBS on first use """
+        context = self._config.context
+        rootdev = context.base_ami.block_device_mapping[context.base_ami.root_device_name]
+        golden_dir = self._local_path('golden_dir', 'golden')
+        golden = os.path.join(golden_dir, '{0}.img'.format(rootdev.snapshot_id))
+        with flock('{0}.lock'.format(golden)):
+            if os.path.exists(golden):
+                log.info('Using local base image {0}'.format(golden))
+                self._config.metrics.increment('aminator.cloud.ec2_local.golden.hit')
+                return golden
+            self._config.metrics.increment('aminator.cloud.ec2_local.golden.miss')
+            log.info('Hydrating local base image {0} from {1}'.format(golden, rootdev.snapshot_id))
+            partial = '{0}.partial'.format(golden)
+            start = time()
+            with self._ebs_device() as dev:
+                self._attach_ebs(dev, rootdev.size, rootdev.snapshot_id)
+                try:
+                    size = device_size(dev)
+                    open(partial, 'w').close()
+                    copy_op = block_copy(dev, partial)
+                    if not copy_op.success:
+                        raise VolumeException('Hydrating {0} failed: {1}'.format(golden, copy_op.result.std_err))
+                    with open(partial, 'a') as image:
+                        # dd leaves a trailing run of zeros unwritten
+                        image.truncate(size)
+                finally:
+                    super(EC2LocalCloudPlugin, self).detach_volume(dev)
+                    super(EC2LocalCloudPlugin, self).delete_volume()
+                    self._volume = None
+            os.rename(partial, golden)
+            self._config.metrics.timer('aminator.cloud.ec2_local.golden.hydrate.duration', time() - start)
+        return golden
+
+    def _volume_size(self, base_size):
+        context = self._config.context
+        volume_size = context.ami.get('root_volume_size', None)
+        if volume_size is None:
+            volume_size = self.plugin_config.get('root_volume_size', None)
+        if volume_size is None:
+            return base_size
+        volume_size = int(volume_size) * 1024 ** 3
+        if volume_size < base_size:
+            raise VolumeException('root_volume_size must be at least as large as the root volume of the base AMI')
+        return volume_size
+
+    def attach_volume(self, blockdevice, tag=True):
+        golden = self._golden_image()
+        self._clone = os.path.join(self._local_path('clone_dir', 'golden/clones'), '{0}-{1}.img'.format(os.getpid(), int(time())))
+        log.debug('Cloning {0} to {1}'.format(golden, self._clone))
+        clone_op = sparse_copy(golden, self._clone)
+        if not clone_op.success:
+            raise VolumeException('Cloning {0} failed: {1}'.format(golden, clone_op.result.std_err))
+        context = self._config.context
+        context.volume['base_size'] = os.path.getsize(golden)
+        context.volume['size'] = self._volume_size(context.volume.base_size)
+        with open(self._clone, 'a') as image:
+            image.truncate(context.volume.size)
+        self._loop_dev = blockdevice
+        attach_op = losetup(blockdevice, self._clone)
+        if not attach_op.success or not self.is_volume_attached(blockdevice):
+            raise VolumeException('Attaching {0} to {1} failed: {2}'.format(self._clone, blockdevice, attach_op.result.std_err))
+        log.debug('Clone {0} attached to {1}'.format(self._clone, blockdevice))
+
+    def is_volume_attached(self, blockdevice):
+        if blockdevice != getattr(self, '_loop_dev', None):
+            return super(EC2LocalCloudPlugin, self).is_volume_attached(blockdevice)
+        return loop_backing_file(blockdevice) == self._clone
+
+    def detach_volume(self, blockdevice):
+        if blockdevice != getattr(self, '_loop_dev', None):
+            return super(EC2LocalCloudPlugin, self).detach_volume(blockdevice)
+        log.debug('Detaching {0} from {1}'.format(self._clone, blockdevice))
+        detach_op = losetup_detach(blockdevice)
+        if not detach_op.success:
+            raise VolumeException('Detaching {0} failed: {1}'.format(blockdevice, detach_op.result.std_err))
+        self._loop_dev = None
+
+    def delete_volume(self):
+        log.debug('Deleting clone {0}'.format(self._clone))
+        try:
+            os.unlink(self._clone)
+        except OSError:
+            log.debug('Unable to delete {0}'.format(self._clone), exc_info=True)
+        if getattr(self, '_volume', None) is not None:
+            return super(EC2LocalCloudPlugin, self).delete_volume()
+        return True
+
+    def _write_back(self):
+        """ copy the baked clone onto a new EBS volume, which is what gets snapshotted """
+        size = os.path.getsize(self._clone)
+        start = time()
+        with self._ebs_device() as dev:
+            self._attach_ebs(dev, (size + 1024 ** 3 - 1) // 1024 ** 3)
+            try:
+                log.info('Writing {0} back to {1}'.format(self._clone, self._volume.id))
+                copy_op = block_copy(self._clone, dev)
+                if not copy_op.success:
+                    raise VolumeException('Writing back to {0} failed: {1}'.format(self._volume.id, copy_op.result.std_err))
+            finally:
+                super(EC2LocalCloudPlugin, self).detach_volume(dev)
+        self._config.metrics.timer('aminator.cloud.ec2_local.write_back.duration', time() - start)
+
+    def snapshot_volume(self, description=None, wait=True):
+        self._write_back()
+        return super(EC2LocalCloudPlugin, self).snapshot_volume(description=description, wait=wait)
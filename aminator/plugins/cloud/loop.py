@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.plugins.cloud.loop
+===========================
+local image file "cloud" for baking without a cloud provider
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from time import time
+
+from bunch import Bunch
+
+from aminator.config import conf_action
+from aminator.exceptions import VolumeException
+from aminator.plugins.cloud.base import BaseCloudPlugin
+from aminator.util.linux import (losetup, losetup_detach, loop_backing_file, mkdir_p, monitor_command,
+                                 os_node_exists, sparse_copy)
+
+__all__ = ('LoopCloudPlugin',)
+log = logging.getLogger(__name__)
+
+
+class LoopCloudPlugin(BaseCloudPlugin):
+    """
+    volumes are sparse image files attached through loop devices, snapshots are copies
+    of those files and registering an image writes its metadata next to the copy
+    """
+    _name = 'loop'
+
+    def add_plugin_args(self, *args, **kwargs):
+        context = self._config.context
+        cloud = self._parser.add_argument_group(
+            title='Loop Options', description='Local image file options')
+        cloud.add_argument(
+            '-b', '--base-image', dest='base_image',
+            action=conf_action(config=context.ami),
+            help='Path of the raw filesystem image to bake on. Without one, an empty filesystem is created')
+        cloud.add_argument(
+            '--root-volume-size', dest='root_volume_size',
+            action=conf_action(config=context.ami),
+            help='Root volume size (in GB). The default is to inherit from the base image.')
+
+    def _path(self, key, default):
+        path = self.plugin_config.get(key, default)
+        if path.startswith(('/', '~')):
+            path = os.path.expanduser(path)
+        else:
+            path = os.path.join(self._config.aminator_root, path)
+        mkdir_p(path)
+        return path
+
+    def connect(self, **kwargs):
+        self._image_dir = self._path('image_dir', 'images')
+        self._output_dir = self._path('output_dir', 'artifacts')
+        self._connection = self
+
+    def _resolve_base_image(self):
+        context = self._config.context
+        base_image = context.ami.get('base_image', self.plugin_config.get('base_image', None))
+        if base_image:
+            base_image = os.path.abspath(os.path.expanduser(base_image))
+            if not os.path.isfile(base_image):
+                raise VolumeException('Base image {0} does not exist'.format(base_image))
+            name = os.path.basename(base_image)
+        else:
+            name = 'empty'
+        context.base_ami = Bunch(
+            id=base_image, name=name, architecture=self.plugin_config.get('architecture', 'x86_64'),
+            kernel_id=None, ramdisk_id=None, tags={})
+        log.info('Base image: {0}'.format(base_image or 'empty filesystem'))
+
+    def _volume_size(self):
+        """ requested size in bytes, None to inherit from the base image """
+        context = self._config.context
+        volume_size = context.ami.get('root_volume_size', None)
+        if volume_size is None:
+            volume_size = self.plugin_config.get('root_volume_size', None)
+        if volume_size is None:
+            return None
+        volume_size = int(volume_size)
+        if volume_size < 1:
+            raise VolumeException('root_volume_size must be a positive integer, received {}'.format(volume_size))
+        return volume_size * 1024 ** 3
+
+    def allocate_base_volume(self, tag=True):
+        context = self._config.context
+        self._volume = os.path.join(self._image_dir, '{0}-{1}.img'.format(os.getpid(), int(time())))
+        volume_size = self._volume_size()
+        base_size = None
+        if context.base_ami.id:
+            log.debug('Copying {0} to {1}'.format(context.base_ami.id, self._volume))
+            copy_op = sparse_copy(context.base_ami.id, self._volume)
+            if not copy_op.success:
+                raise VolumeException('Copying {0} failed: {1}'.format(context.base_ami.id, copy_op.result.std_err))
+            base_size = os.path.getsize(self._volume)
+            if volume_size is not None and volume_size < base_size:
+                raise VolumeException(
+                    'root_volume_size must be at least as large as the base image ({0} bytes)'.format(base_size))
+        if volume_size is None and not context.base_ami.id:
+            volume_size = int(self.plugin_config.get('empty_volume_size', 10)) * 1024 ** 3
+        if volume_size is not None:
+            with open(self._volume, 'a') as image:
+                # extending a file leaves a hole, no blocks are written
+                image.truncate(volume_size)
+        context.volume['size'] = os.path.getsize(self._volume)
+        context.volume['base_size'] = base_size or context.volume.size
+        if not context.base_ami.id:
+            mkfs_op = monitor_command(['mkfs.{0}'.format(self.plugin_config.get('empty_fs_type', 'ext4')), '-F', '-q', self._volume])
+            if not mkfs_op.success:
+                raise VolumeException('Creating a filesystem on {0} failed: {1}'.format(self._volume, mkfs_op.result.std_err))
+        context.volume['id'] = self._volume
+        log.debug('Volume {0} created'.format(self._volume))
+
+    def attach_volume(self, blockdevice, tag=True):
+        self.allocate_base_volume(tag=tag)
+        log.debug('Attaching {0} to {1}'.format(self._volume, blockdevice))
+        attach_op = losetup(blockdevice, self._volume)
+        if not attach_op.success or not self.is_volume_attached(blockdevice):
+            raise VolumeException('Attaching {0} to {1} failed: {2}'.format(self._volume, blockdevice, attach_op.result.std_err))
+        log.debug('Volume {0} attached to {1}'.format(self._volume, blockdevice))
+
+    def is_volume_attached(self, blockdevice):
+        return os_node_exists(blockdevice) and loop_backing_file(blockdevice) == self._volume
+
+    def detach_volume(self, blockdevice):
+        log.debug('Detaching {0} from {1}'.format(self._volume, blockdevice))
+        detach_op = losetup_detach(blockdevice)
+        if not detach_op.success:
+            raise VolumeException('Detaching {0} failed: {1}'.format(blockdevice, detach_op.result.std_err))
+
+    def delete_volume(self):
+        log.debug('Deleting volume {0}'.format(self._volume))
+        try:
+            os.unlink(self._volume)
+        except OSError:
+            log.debug('Unable to delete {0}'.format(self._volume), exc_info=True)
+            return False
+        return True
+
+    def cleanup_volume(self, volume_id, blockdevice):
+        if blockdevice and loop_backing_file(blockdevice) == volume_id:
+            self._volume = volume_id
+            self.detach_volume(blockdevice)
+        if os.path.exists(volume_id):
+            os.unlink(volume_id)
+        return True
+
+    def snapshot_volume(self, description=None, wait=True):
+        context = self._config.context
+        self._snapshot = os.path.join(self._output_dir, '{0}.img'.format(context.ami.name))
+        log.debug('Copying {0} to {1}'.format(self._volume, self._snapshot))
+        # the loop device may still hold dirty pages for the file
+        monitor_command(['sync'])
+        copy_op = sparse_copy(self._volume, self._snapshot)
+        if not copy_op.success:
+            log.critical('Copying {0} failed: {1}'.format(self._volume, copy_op.result.std_err))
+            return False
+        log.debug('Snapshot complete. id: {0}'.format(self._snapshot))
+        return True
+
+    def register_image(self, *args, **kwargs):
+        context = self._config.context
+        self._ami = Bunch(
+            id=self._snapshot, name=context.ami.name, description=context.ami.get('description', ''),
+            kernel_id=None, ramdisk_id=None, architecture=context.base_ami.architecture,
+            virtualization_type=context.ami.get('vm_type', 'hvm'), tags={})
+        context.ami.id = self._ami.id
+        context.ami.image = self._ami
+        self._write_metadata()
+        log.info('AMI registered: {0} {1}'.format(self._ami.id, self._ami.name))
+        return True
+
+    def wait_for_image(self):
+        return True
+
+    def add_tags(self, resource_types):
+        context = self._config.context
+        if isinstance(resource_types, basestring):
+            resource_types = [resource_types]
+        if 'ami' in resource_types:
+            self._ami.tags.update((key, str(value)) for (key, value) in context.ami.tags.iteritems())
+            self._write_metadata()
+        return True
+
+    def _write_metadata(self):
+        context = self._config.context
+        metadata = dict(self._ami)
+        metadata['base_image'] = context.base_ami.id
+        metadata['created'] = '{0:%F %T UTC}'.format(datetime.utcnow())
+        with open('{0}.json'.format(os.path.splitext(self._snapshot)[0]), 'w') as fh:
+            json.dump(metadata, fh, indent=2, sort_keys=True)
+
+    def is_stale_attachment(self, dev, prefix, refresh=True):
+        return False
+
+    def attached_block_devices(self, prefix, refresh=True):
+        return {}
+
+    def __enter__(self):
+        self.connect()
+        self._resolve_base_image()
+        return self
@@ -31,10 +31,13 @@ from aminator.exceptions import VolumeException
 from aminator.plugins.distro.base import BaseDistroPlugin
 from aminator.util import retry
 from aminator.util.linux import (
-    lifo_mounts, mount, mounted, MountSpec, unmount, busy_mount)
+    lifo_mounts, mount, mounted, MountSpec, unmount, busy_mount, grow_filesystem, probe_filesystem)
+from aminator.util.linux import (
+    kill_chroot_processes, leave_mount_namespace, mount_namespace, mount_namespace_pids, private_mount_namespace)
 from aminator.util.linux import install_provision_configs, remove_provision_configs
 from aminator.util.linux import short_circuit_files, rewire_files
 from aminator.util.metrics import fails, timer, raises
+from aminator.util.pkgcache import PackageCache
 
 __all__ = ('BaseLinuxDistroPlugin',)
 log = logging.getLogger(__name__)
@@ -86,7 +89,7 @@ class BaseLinuxDistroPlugin(BaseDistroPlugin):
     @fails("aminator.distro.linux.mount.error")
     def _mount(self, mountspec):
         if not mounted(mountspec):
-            result = mount(mountspec)
+            result = mount(mountspec, backend=self.plugin_config.get('mount_backend', 'command'))
             if not result.success:
                 msg = 'Unable to mount {0.dev} at {0.mountpoint}: {1}'.format(mountspec, result.result.std_err)
                 log.critical(msg)
@@ -99,7 +102,8 @@ class BaseLinuxDistroPlugin(BaseDistroPlugin):
     def _unmount(self, mountspec):
         recursive_unmount = self.plugin_config.get('recursive_unmount', False)
         if mounted(mountspec):
-            result = unmount(mountspec, recursive=recursive_unmount)
+            result = unmount(mountspec, recursive=recursive_unmount, lazy=self.plugin_config.get('lazy_unmount', False),
+                             backend=self.plugin_config.get('mount_backend', 'command'))
             if not result.success:
                 err = 'Failed to unmount {0}: {1}'
                 err = err.format(mountspec.mountpoint, result.result.std_err)
@@ -139,6 +143,9 @@ class BaseLinuxDistroPlugin(BaseDistroPlugin):
         if not self._mount(self.root_mountspec):
             log.critical('Failed to mount root volume')
             return False
+        if self.context.volume.get('grow', False) and not self._grow_root():
+            log.critical('Failed to grow root volume')
+            return False
         if self.plugin_config.get('configure_mounts', True):
             for mountdef in self.plugin_config.chroot_mounts:
                 dev, fstype, mountpoint, options = mountdef
@@ -149,9 +156,72 @@ class BaseLinuxDistroPlugin(BaseDistroPlugin):
                 if not self._mount(mountspec):
                     log.critical('Mount failure, unable to configure chroot')
                     return False
+        if self.plugin_config.get('package_cache', False) and not self._mount_package_cache():
+            log.critical('Failed to mount package cache')
+            return False
         log.debug('Mounts configured')
         return True
 
+    def _mount_package_cache(self):
+        config = self.plugin_config
+        cache_dir = config.get('package_cache_dir', 'package_cache')
+        if not cache_dir.startswith(('~', '/')):
+            cache_dir = os.path.join(self._config.aminator_root, cache_dir)
+        self._package_cache = PackageCache(os.path.expanduser(cache_dir), config.get('package_cache_size', 10240) * 1024 ** 2)
+        stage, seeded = self._package_cache.stage(config.get('package_cache_subdirs', []))
+        log.info('Package cache provides {0} packages'.format(seeded))
+        self._config.metrics.gauge('aminator.distro.linux.package_cache.seeded', seeded)
+        mountpoint = os.path.join(self.root_mountspec.mountpoint, config.package_cache_path.lstrip('/'))
+        # directories made for the mount point leave the image along with the mount
+        self._package_cache_dirs = []
+        path = mountpoint
+        while not os.path.exists(path):
+            self._package_cache_dirs.append(path)
+            path = os.path.dirname(path)
+        self._package_cache_mountspec = MountSpec(stage, 'bind', mountpoint, None)
+        if not self._mount(self._package_cache_mountspec):
+            return False
+        self.context.package_cache = config.package_cache_path
+        return True
+
+    def _release_package_cache(self):
+        """ unmount the package cache, keeping it out of the image, and add what was downloaded to it """
+        mountspec = self._package_cache_mountspec
+        self._package_cache_mountspec = None
+        self.context.package_cache = None
+        try:
+            self._unmount(mountspec)
+        except VolumeException:
+            log.critical('Unable to unmount package cache at {0.mountpoint}'.format(mountspec))
+            return False
+        for path in self._package_cache_dirs:
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+        try:
+            added = self._package_cache.harvest(mountspec.dev, self.plugin_config.get('package_cache_extension', ''))
+        except Exception:
+            # a cache that can't be updated is no reason to fail the bake
+            log.warning('Unable to update the package cache', exc_info=True)
+        else:
+            self._config.metrics.gauge('aminator.distro.linux.package_cache.added', added)
+        return True
+
+    @timer("aminator.distro.linux.grow_root.duration")
+    def _grow_root(self):
+        fstype = self.context.volume.get('fstype', None) or probe_filesystem(self.root_mountspec.dev)[0]
+        log.info('Resizing {0} root fs to fill volume'.format(fstype))
+        try:
+            result = grow_filesystem(fstype, self.root_mountspec.dev, self.root_mountspec.mountpoint)
+        except ValueError as e:
+            log.critical(str(e))
+            return False
+        if not result.success:
+            log.critical('Online resize of {0} failed: {1}'.format(self.root_mountspec.dev, result.result.std_err))
+            return False
+        return True
+
     def _install_provision_configs(self):
         config = self.plugin_config
         files = config.get('provision_config_files', [])
@@ -195,6 +265,12 @@ class BaseLinuxDistroPlugin(BaseDistroPlugin):
         return True
 
     def _teardown_chroot_mounts(self):
+        if self.plugin_config.get('kill_chroot_processes', False):
+            kill_chroot_processes(self.root_mountspec.mountpoint)
+        if self._package_cache_mountspec is not None and not self._release_package_cache():
+            return False
+        if self._host_namespace is not None:
+            return self._leave_mount_namespace()
         if not self.plugin_config.get('recursive_unmount', False):
             if self.plugin_config.get('configure_mounts', True):
                 for mountdef in reversed(self.plugin_config.chroot_mounts):
@@ -212,18 +288,36 @@ class BaseLinuxDistroPlugin(BaseDistroPlugin):
                 for mountpoint in lifo_mounts(self.root_mountspec.mountpoint):
                     log.debug('Stray mount found: {0}, attempting to unmount'.format(mountpoint))
                     try:
-                        self._unmount(mountpoint)
+                        self._unmount(MountSpec(None, None, mountpoint, None))
                     except VolumeException as ve:
                         log.critical('Unable to unmount {0}'.format(mountpoint))
                         return False
         if not self._unmount_root():
-            err = 'Unable to unmount root volume at {0.mountpoint)'
+            err = 'Unable to unmount root volume at {0.mountpoint}'
             err = err.format(self.root_mountspec)
             log.critical(err)
             return False
         log.debug('Teardown of chroot mounts succeeded!')
         return True
 
+    def _enter_mount_namespace(self):
+        log.debug('Moving chroot mounts into a private mount namespace')
+        self._host_namespace = private_mount_namespace()
+        self._namespace = mount_namespace()
+
+    def _leave_mount_namespace(self):
+        """ the chroot mounts go away with the namespace once the last process in it is gone """
+        log.debug('Leaving private mount namespace')
+        leave_mount_namespace(self._host_namespace)
+        self._host_namespace = None
+        stragglers = mount_namespace_pids(self._namespace)
+        if stragglers:
+            log.critical('Processes {0} are still running in the chroot mount namespace, '
+                         'root volume remains mounted'.format(', '.join(str(pid) for pid in stragglers)))
+            return False
+        log.debug('Teardown of chroot mounts succeeded!')
+        return True
+
     def _remove_provision_configs(self):
         config = self.plugin_config
         files = config.get('provision_config_files', [])
@@ -250,21 +344,38 @@ class BaseLinuxDistroPlugin(BaseDistroPlugin):
         root_mountpoint = os.path.join(root_base, os.path.basename(self.context.volume.dev))
         self._root_mountspec = MountSpec(self.context.volume.dev, None, root_mountpoint, None)
 
+        self._host_namespace = None
+        self._package_cache_mountspec = None
         try:
+            if self.plugin_config.get('private_mount_namespace', False):
+                self._enter_mount_namespace()
             chroot_setup = self._configure_chroot()
-        except Exception as e:
+        except Exception:
             chroot_setup = False
-            log.critical('Error encountered during chroot setup. Attempting to clean up volumes.')
-            self._teardown_chroot_mounts()
+            log.debug('Exception encountered during chroot setup', exc_info=True)
         if not chroot_setup:
+            log.critical('Error encountered during chroot setup. Attempting to clean up volumes.')
+            self._abort_chroot_setup()
             raise VolumeException('Error configuring chroot')
         return self
 
+    def _abort_chroot_setup(self):
+        """ undo a partial chroot setup, leaving the private mount namespace whatever else fails """
+        try:
+            self._teardown_chroot_mounts()
+        except Exception:
+            log.critical('Error cleaning up after failed chroot setup', exc_info=True)
+        finally:
+            if self._host_namespace is not None:
+                self._leave_mount_namespace()
+
     def __exit__(self, exc_type, exc_value, trace):
         if exc_type:
             log.debug('Exception encountered in Linux distro plugin context manager',
                       exc_info=(exc_type, exc_value, trace))
         if exc_type and self._config.context.get("preserve_on_error", False):
+            if self._host_namespace is not None:
+                log.warning('Chroot mounts are private to this process and go away when it exits')
             return False
         if not self._teardown_chroot():
             raise VolumeException('Error tearing down chroot')
@@ -91,17 +91,20 @@ class TaggingBaseFinalizerPlugin(BaseFinalizerPlugin):
 
     def _add_tags(self, resources):
         context = self._config.context
-        context.ami.tags.creation_time = '{0:%F %T UTC}'.format(datetime.utcnow())
+        creation_time = '{0:%F %T UTC}'.format(datetime.utcnow())
         for resource in resources:
-            try:
-                self._cloud.add_tags(resource)
-            except FinalizerException:
-                errstr = 'Error adding tags to {0}'.format(resource)
-                log.error(errstr)
-                log.debug(errstr, exc_info=True)
+            # identical tag sets let the cloud tag everything in one call
+            context[resource].tags.creation_time = creation_time
+        try:
+            if not self._cloud.add_tags(resources):
+                log.error('Unable to add tags to {0}'.format(', '.join(resources)))
                 return False
-            log.info('Successfully tagged {0}'.format(resource))
-        log.info('Successfully tagged objects')
+        except FinalizerException:
+            errstr = 'Error adding tags to {0}'.format(', '.join(resources))
+            log.error(errstr)
+            log.debug(errstr, exc_info=True)
+            return False
+        log.info('Successfully tagged {0}'.format(', '.join(resources)))
         return True
 
     def _log_ami_metadata(self):
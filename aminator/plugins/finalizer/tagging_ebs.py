@@ -43,6 +43,7 @@ class TaggingEBSFinalizerPlugin(TaggingBaseFinalizerPlugin):
 
         context = self._config.context
         tagging.add_argument('-n', '--name', dest='name', action=conf_action(context.ami), help='name of resultant AMI (default package_name-version-release-arch-yyyymmddHHMM-ebs')
+        tagging.add_argument('--copy-region', dest='copy_regions', action=conf_action(context.ami, action='append'), help='region to copy the resultant AMI to. May be given more than once')
 
     def _set_metadata(self):
         super(TaggingEBSFinalizerPlugin, self)._set_metadata()
@@ -55,34 +56,48 @@ class TaggingEBSFinalizerPlugin(TaggingBaseFinalizerPlugin):
 
         context.ami.name = sanitize_metadata('{0}-ebs'.format(ami_name))
 
-    def _snapshot_volume(self):
+    def _snapshot_volume(self, wait=True):
         log.info('Taking a snapshot of the target volume')
-        if not self._cloud.snapshot_volume():
+        if not self._cloud.snapshot_volume(wait=wait):
             return False
         log.info('Snapshot success')
         return True
 
-    def _register_image(self, block_device_map=None, root_device=None):
+    def _register_image(self, block_device_map=None, root_device=None, wait=True):
         log.info('Registering image')
         config = self._config.plugins[self.full_name]
         if block_device_map is None:
             block_device_map = config.default_block_device_map
         if root_device is None:
             root_device = config.default_root_device
-        if not self._cloud.register_image(block_device_map, root_device):
+        if not self._cloud.register_image(block_device_map, root_device, wait=wait):
             return False
         log.info('Registration success')
         return True
 
+    def _copy_image(self):
+        config = self._config.plugins[self.full_name]
+        context = self._config.context
+        regions = context.ami.get('copy_regions', None) or config.get('copy_regions', None) or []
+        if not regions:
+            return True
+        log.info('Copying image to {0}'.format(', '.join(regions)))
+        if not self._cloud.copy_image(regions):
+            return False
+        log.info('Copy success')
+        return True
+
     def finalize(self):
         log.info('Finalizing image')
         self._set_metadata()
+        # when pipelining, register against the pending snapshot and wait once for the AMI
+        pipeline = self.plugin_config.get('pipeline', False)
 
-        if not self._snapshot_volume():
+        if not self._snapshot_volume(wait=not pipeline):
             log.critical('Error snapshotting volume')
             return False
 
-        if not self._register_image():
+        if not self._register_image(wait=not pipeline):
             log.critical('Error registering image')
             return False
 
@@ -90,8 +105,17 @@ class TaggingEBSFinalizerPlugin(TaggingBaseFinalizerPlugin):
             log.critical('Error adding tags')
             return False
 
+        if pipeline and not self._cloud.wait_for_image():
+            log.critical('Error waiting for image')
+            return False
+
         log.info('Image registered and tagged')
         self._log_ami_metadata()
+
+        if not self._copy_image():
+            log.critical('Error copying image')
+            return False
+
         return True
 
     def __enter__(self):
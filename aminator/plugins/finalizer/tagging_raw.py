@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.plugins.finalizer.tagging_raw
+======================================
+raw image file finalizer
+"""
+import logging
+
+from os import environ
+from aminator.config import conf_action
+from aminator.plugins.finalizer.tagging_base import TaggingBaseFinalizerPlugin
+from aminator.util.linux import sanitize_metadata
+
+
+__all__ = ('TaggingRawFinalizerPlugin',)
+log = logging.getLogger(__name__)
+
+
+class TaggingRawFinalizerPlugin(TaggingBaseFinalizerPlugin):
+    _name = 'tagging_raw'
+
+    def add_plugin_args(self):
+        tagging = super(TaggingRawFinalizerPlugin, self).add_plugin_args()
+
+        context = self._config.context
+        tagging.add_argument('-n', '--name', dest='name', action=conf_action(context.ami), help='name of resultant image (default package_name-version-release-arch-yyyymmddHHMM-raw')
+
+    def _set_metadata(self):
+        super(TaggingRawFinalizerPlugin, self)._set_metadata()
+        context = self._config.context
+        config = self._config.plugins[self.full_name]
+        metadata = context.package.attributes
+        ami_name = context.ami.get('name', None)
+        if not ami_name:
+            ami_name = config.name_format.format(**metadata)
+
+        context.ami.name = sanitize_metadata('{0}-raw'.format(ami_name))
+
+    def finalize(self):
+        log.info('Finalizing image')
+        self._set_metadata()
+
+        if not self._cloud.snapshot_volume():
+            log.critical('Error copying image')
+            return False
+
+        if not self._cloud.register_image():
+            log.critical('Error registering image')
+            return False
+
+        if not self._add_tags(['ami']):
+            log.critical('Error adding tags')
+            return False
+
+        log.info('Image registered and tagged')
+        self._log_ami_metadata()
+        return True
+
+    def __enter__(self):
+        context = self._config.context
+        environ["AMINATOR_STORE_TYPE"] = "raw"
+        if context.ami.get("name", None):
+            environ["AMINATOR_AMI_NAME"] = context.ami.name
+        return super(TaggingRawFinalizerPlugin, self).__enter__()
@@ -29,7 +29,8 @@ import os
 from aminator.exceptions import ProvisionException
 from aminator.plugins.provisioner.base import BaseProvisionerPlugin
 from aminator.util import retry
-from aminator.util.linux import monitor_command, result_to_dict
+from aminator.util.linux import Chroot, CommandResult, Response, monitor_command, result_to_dict
+from aminator.util.metadata import MetadataCache, configuration_key, is_refreshed, metadata_files, touch_stamp
 from aminator.util.metrics import cmdsucceeds, cmdfails, timer, lapse
 
 __all__ = ('AptProvisionerPlugin',)
@@ -78,6 +79,47 @@ class AptProvisionerPlugin(BaseProvisionerPlugin):
             metadata.setdefault(x, None)
         context.package.attributes = metadata
 
+    def _pre_chroot_block(self):
+        if self.plugin_config.get('metadata_cache', False):
+            self._seed_metadata()
+
+    def _seed_metadata(self):
+        """
+        copy the lists from the host-wide metadata cache into the chroot, refreshing the cache
+        first if it is older than metadata_cache_ttl. concurrent bakes wait for a refresh in
+        progress rather than starting their own
+        """
+        config = self.plugin_config
+        root = self._distro.root_mountspec.mountpoint
+        cache_dir = config.get('metadata_cache_dir', 'metadata_cache')
+        if not cache_dir.startswith(('~', '/')):
+            cache_dir = os.path.join(self._config.aminator_root, cache_dir)
+        cache = MetadataCache(os.path.expanduser(cache_dir), config.get('metadata_cache_ttl', 900))
+        key = configuration_key(root, config.get('metadata_config_files', []))
+        lists = os.path.join(root, config.get('metadata_lists', '/var/lib/apt/lists').lstrip('/'))
+        context = self._config.context
+        with cache.lock(key):
+            if cache.fresh(key):
+                cache.seed(key, lists)
+            else:
+                log.info('Refreshing repository metadata cache')
+                with Chroot(root):
+                    self.apt_get_update()
+                cache.export(key, lists, metadata_files(root, config.get('metadata_files', [])))
+        context.package.metadata_fresh = True
+
+    def _metadata_fresh(self, root='/'):
+        """
+        inside the chroot, whether apt-get update can be skipped: the last successful update,
+        recorded in metadata_stamp, is younger than metadata_ttl and its lists are still there
+        """
+        if self._config.context.package.get('metadata_fresh', False):
+            return True
+        config = self.plugin_config
+        ttl = config.get('metadata_ttl', 0)
+        stamp = os.path.join(root, config.get('metadata_stamp', '/var/lib/apt/periodic/update-success-stamp').lstrip('/'))
+        return ttl > 0 and is_refreshed(stamp, metadata_files(root, config.get('metadata_files', [])), ttl)
+
     @staticmethod
     def dpkg_install(package):
         dpkg_result = monitor_command(['dpkg', '-i', package])
@@ -130,13 +172,19 @@ class AptProvisionerPlugin(BaseProvisionerPlugin):
     @timer("aminator.provisioner.apt.apt_get_update.duration")
     @retry(ExceptionToCheck=AptProvisionerUpdateException, tries=5, delay=1, backoff=0.5, logger=log)
     def apt_get_update(self):
-        self.apt_get_clean()
+        if self._metadata_fresh():
+            log.info('Repository metadata is fresh, skipping apt-get update')
+            return CommandResult(True, Response('apt-get update', '', '', 0))
+        # cleaning would throw away the packages seeded from the package cache
+        if not self._config.context.get('package_cache', False):
+            self.apt_get_clean()
         dpkg_update = monitor_command(['apt-get', 'update'])
         if not dpkg_update.success:
             log.debug('failure: {0.command} :{0.std_err}'.format(dpkg_update.result))
             # trigger retry. expiring retries should fail the bake as this
             # exception will propagate out to the provisioning context handler
             raise AptProvisionerUpdateException('apt-get update failed')
+        touch_stamp(self.plugin_config.get('metadata_stamp', '/var/lib/apt/periodic/update-success-stamp'))
         return dpkg_update
 
     @staticmethod
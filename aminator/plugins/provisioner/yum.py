@@ -27,7 +27,8 @@ import logging
 import os
 
 from aminator.plugins.provisioner.base import BaseProvisionerPlugin
-from aminator.util.linux import monitor_command, result_to_dict
+from aminator.util.linux import CommandResult, Response, monitor_command, result_to_dict
+from aminator.util.metadata import is_fresh, metadata_files
 from aminator.util.metrics import cmdsucceeds, cmdfails, lapse
 
 __all__ = ('YumProvisionerPlugin',)
@@ -43,8 +44,27 @@ class YumProvisionerPlugin(BaseProvisionerPlugin):
 
     def _refresh_repo_metadata(self):
         config = self._config.plugins[self.full_name]
+        ttl = config.get('metadata_ttl', 0)
+        if ttl > 0 and self._metadata_fresh(config, ttl):
+            log.info('Repository metadata is fresh, skipping yum clean metadata')
+            return CommandResult(True, Response('yum clean metadata', '', '', 0))
         return yum_clean_metadata(config.get('clean_repos', []))
 
+    @staticmethod
+    def _metadata_fresh(config, ttl, root='/'):
+        """
+        inside the chroot, whether every repository was refreshed within ttl. yum touches a
+        repository's cachecookie when it fetches its metadata, repomd.xml keeps the server's time
+        """
+        files = metadata_files(root, config.get('metadata_files', []))
+        repos = config.get('clean_repos', [])
+        if repos:
+            # the cookie lives in a directory named for its repository
+            files = [path for path in files if os.path.basename(os.path.dirname(path)) in repos]
+            if set(os.path.basename(os.path.dirname(path)) for path in files) != set(repos):
+                return False
+        return is_fresh(files, ttl)
+
     @cmdsucceeds("aminator.provisioner.yum.provision_package.count")
     @cmdfails("aminator.provisioner.yum.provision_package.error")
     @lapse("aminator.provisioner.yum.provision_package.duration")
@@ -54,10 +74,12 @@ class YumProvisionerPlugin(BaseProvisionerPlugin):
             log.critical('Repo metadata refresh failed: {0.std_err}'.format(result.result))
             return result
         context = self._config.context
+        # the package cache mounted by the distro plugin, if any, where yum is to download to
+        pkgdir = context.get('package_cache', None)
         if context.package.get('local_install', False):
-            return yum_localinstall(context.package.arg)
+            return yum_localinstall(context.package.arg, pkgdir=pkgdir)
         else:
-            return yum_install(context.package.arg)
+            return yum_install(context.package.arg, pkgdir=pkgdir)
 
     def _store_package_metadata(self):
         context = self._config.context
@@ -68,15 +90,24 @@ class YumProvisionerPlugin(BaseProvisionerPlugin):
         context.package.attributes = metadata
 
 
-def yum_install(package):
-    return monitor_command(['yum', '--nogpgcheck', '-y', 'install', package])
+def _yum(pkgdir=None):
+    cmd = ['yum', '--nogpgcheck', '-y']
+    if pkgdir:
+        # download every repository's packages to pkgdir, away from the metadata in cachedir,
+        # and keep them there after installing
+        cmd.extend(['--setopt=keepcache=1', '--setopt=*.pkgdir={0}'.format(pkgdir)])
+    return cmd
+
+
+def yum_install(package, pkgdir=None):
+    return monitor_command(_yum(pkgdir) + ['install', package])
 
 
-def yum_localinstall(path):
+def yum_localinstall(path, pkgdir=None):
     if not os.path.isfile(path):
         log.critical('Package {0} not found'.format(path))
         return None
-    return monitor_command(['yum', '--nogpgcheck', '-y', 'localinstall', path])
+    return monitor_command(_yum(pkgdir) + ['localinstall', path])
 
 
 def yum_clean_metadata(repos=None):
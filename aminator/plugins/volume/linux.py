@@ -23,9 +23,17 @@ aminator.plugins.volume.linux
 =============================
 basic linux volume allocator
 """
+import errno
+import fcntl
+import json
 import logging
+import os
+import threading
+from glob import glob
+from time import time
 
-from aminator.util.linux import resize2fs, fsck, growpart
+from aminator.util import retry
+from aminator.util.linux import daemonize, device_size, ext_used_extents, probe_filesystem, read_extents, resize2fs, fsck, growpart, mkdir_p
 from aminator.exceptions import VolumeException
 from aminator.plugins.volume.base import BaseVolumePlugin
 
@@ -41,7 +49,9 @@ class LinuxVolumePlugin(BaseVolumePlugin):
         with blockdevice(self._cloud) as dev:
             self._dev = dev
             if blockdevice.partition is not None:
-                devpart = '{0}{1}'.format(dev, blockdevice.partition)
+                # partitions of devices whose names end in a digit (loop0, nvme1n1) are named loop0p1
+                separator = 'p' if dev[-1].isdigit() else ''
+                devpart = '{0}{1}{2}'.format(dev, separator, blockdevice.partition)
                 self.context.volume['dev'] = devpart
             else:
                 self.context.volume['dev'] = self._dev
@@ -49,14 +59,31 @@ class LinuxVolumePlugin(BaseVolumePlugin):
 
     def _detach(self):
         self._cloud.detach_volume(self._dev)
+        self._blockdevice.detached(self._dev)
+
+    def _needs_grow(self, fs_size):
+        """
+        whether the root filesystem has room to grow into: the cloud made the volume larger
+        than its base, or the filesystem falls short of the device by more than resize_threshold
+        """
+        volume = self.context.volume
+        if volume.get('size', None) is not None and volume.get('base_size', None) is not None and volume.size > volume.base_size:
+            return True
+        if fs_size is None:
+            return True
+        threshold = self.plugin_config.get('resize_threshold', 16) * 1024 ** 2
+        # the partition table is not consulted, the disk is compared against the filesystem
+        return device_size(self._dev) - fs_size > threshold
 
     def _resize(self):
-        log.info('Checking and repairing root volume as necessary')
-        fsck_op = fsck(self.context.volume.dev)
-        if not fsck_op.success:
-            raise VolumeException(
-                'fsck of {} failed: {}'.format(self.context.volume.dev, fsck_op.result.std_err))
-        log.info('Attempting to resize root fs to fill volume')
+        fstype, fs_size = probe_filesystem(self.context.volume.dev)
+        log.debug('Root volume {0} holds a {1} filesystem'.format(self.context.volume.dev, fstype))
+        self.context.volume['fstype'] = fstype
+        if not self._needs_grow(fs_size):
+            log.info('Root volume size unchanged, skipping fsck and resize')
+            return
+        if fstype is None:
+            raise VolumeException('Unable to identify the filesystem on {0} to resize it'.format(self.context.volume.dev))
         if self._blockdevice.partition is not None:
             log.info('Growing partition if necessary')
             growpart_op = growpart(self._dev, self._blockdevice.partition)
@@ -65,6 +92,18 @@ class LinuxVolumePlugin(BaseVolumePlugin):
                 raise VolumeException(
                     volmsg.format(
                         self._dev, self._blockdevice.partition, growpart_op.result.std_err))
+        # xfs and btrfs only grow while mounted
+        if self.plugin_config.get('online_resize', True) or not fstype.startswith('ext'):
+            # grown by the distro plugin once the root volume is mounted, no fsck needed
+            log.info('Root fs will be resized to fill volume once mounted')
+            self.context.volume['grow'] = True
+            return
+        log.info('Checking and repairing root volume as necessary')
+        fsck_op = fsck(self.context.volume.dev)
+        if not fsck_op.success:
+            raise VolumeException(
+                'fsck of {} failed: {}'.format(self.context.volume.dev, fsck_op.result.std_err))
+        log.info('Attempting to resize root fs to fill volume')
         resize_op = resize2fs(self.context.volume.dev)
         if not resize_op.success:
             raise VolumeException(
@@ -73,18 +112,136 @@ class LinuxVolumePlugin(BaseVolumePlugin):
     def _delete(self):
         self._cloud.delete_volume()
 
+    def _cleanup_dir(self):
+        cleanup_dir = self.plugin_config.get('cleanup_dir', 'cleanup')
+        if cleanup_dir.startswith(('/', '~')):
+            cleanup_dir = os.path.expanduser(cleanup_dir)
+        else:
+            cleanup_dir = os.path.join(self._config.aminator_root, cleanup_dir)
+        mkdir_p(cleanup_dir)
+        return cleanup_dir
+
+    @retry(VolumeException, tries=7, delay=1, backoff=2, logger=log)
+    def _cleanup_volume(self, volume_id, dev):
+        return self._cloud.cleanup_volume(volume_id, dev)
+
+    def _defer_cleanup(self):
+        """
+        hand the volume and its device lock to a detached worker so the bake can return as soon
+        as the image is registered. A journal entry, locked for as long as the worker runs,
+        records the volume so a later bake can reap it if the worker dies or fails
+        """
+        volume_id = self.context.volume.id
+        journal = os.path.join(self._cleanup_dir(), '{0}.json'.format(volume_id))
+        with open(journal, 'w') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            json.dump({'volume_id': volume_id, 'dev': self._dev, 'status': 'pending'}, fh)
+            fh.flush()
+            log.info('Deferring detach and delete of {0}'.format(volume_id))
+            daemonize(self._deferred_cleanup, volume_id, self._dev, journal)
+
+    def _deferred_cleanup(self, volume_id, dev, journal):
+        device = self._blockdevice.lock_dev(dev)
+        try:
+            self._cloud.reconnect()
+            if self._cleanup_volume(volume_id, dev):
+                self._blockdevice.detached(dev)
+                os.unlink(journal)
+                return
+            error = 'volume not owned by this instance'
+        except Exception as e:
+            log.exception('Deferred cleanup of {0} failed'.format(volume_id))
+            error = str(e)
+        finally:
+            self._blockdevice.release_dev(device)
+        with open(journal, 'w') as fh:
+            json.dump({'volume_id': volume_id, 'dev': dev, 'status': 'failed', 'error': error}, fh)
+
+    def _reap_deferred_cleanups(self):
+        """ finish cleanups whose worker is gone. journals still locked belong to a live worker """
+        for journal in glob(os.path.join(self._cleanup_dir(), '*.json')):
+            with open(journal, 'a+') as fh:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as e:
+                    if e.errno == errno.EAGAIN:
+                        continue
+                    raise
+                fh.seek(0)
+                try:
+                    entry = json.load(fh)
+                except ValueError:
+                    log.warn('Removing unreadable cleanup journal {0}'.format(journal))
+                    os.unlink(journal)
+                    continue
+                try:
+                    log.info('Reaping volume {0} ({1})'.format(entry['volume_id'], entry.get('error', entry.get('status'))))
+                    if self._cloud.cleanup_volume(entry['volume_id'], entry.get('dev')):
+                        os.unlink(journal)
+                except NotImplementedError:
+                    log.debug('{0} cloud plugin cannot clean up volumes, not reaping'.format(self._cloud.full_name))
+                    return
+                except Exception:
+                    # a volume that can't be reaped now is left for a later bake, never fails this one
+                    log.warn('Unable to reap volume from {0}'.format(journal), exc_info=True)
+
+    def _hydrate(self):
+        """ read every allocated block of the volume so none is lazily loaded during provisioning """
+        dev = self.context.volume.dev
+        extents = ext_used_extents(dev)
+        if extents is None:
+            log.debug('No allocation map for {0}, reading all of it'.format(dev))
+            extents = [(0, device_size(dev))]
+        readers = self.plugin_config.get('hydrate_readers', 8)
+        chunk_size = self.plugin_config.get('hydrate_chunk_size', 1024) * 1024
+        log.info('Hydrating {0} with {1} readers'.format(dev, readers))
+        start = time()
+        total = read_extents(dev, extents, readers=readers, chunk_size=chunk_size, stop=self._hydrate_stop)
+        elapsed = max(time() - start, 0.001)
+        rate = total / elapsed / 1024 ** 2
+        log.info('Hydrated {0:.0f}MB of {1} in {2:.1f}s ({3:.1f}MB/s)'.format(total / 1024.0 ** 2, dev, elapsed, rate))
+        self._config.metrics.timer('aminator.volume.linux.hydrate.duration', elapsed)
+        self._config.metrics.gauge('aminator.volume.linux.hydrate.mbps', rate)
+
+    def _start_hydration(self):
+        self._hydrate_stop = threading.Event()
+        self._hydrator = threading.Thread(target=self._hydrate, name='hydrate-volume')
+        self._hydrator.daemon = True
+        self._hydrator.start()
+        if self.plugin_config.get('hydrate_wait', False):
+            self._hydrator.join()
+
+    def _stop_hydration(self):
+        hydrator = getattr(self, '_hydrator', None)
+        if hydrator is not None and hydrator.is_alive():
+            log.debug('Stopping volume hydration')
+            self._hydrate_stop.set()
+            hydrator.join()
+
     def __enter__(self):
+        if self.plugin_config.get('deferred_cleanup', False):
+            try:
+                self._reap_deferred_cleanups()
+            except Exception:
+                log.warn('Unable to reap deferred cleanups', exc_info=True)
         self._attach(self._blockdevice)
         if self.plugin_config.get('resize_volume', False):
             self._resize()
+        if self.plugin_config.get('hydrate', False):
+            # runs alongside chroot setup and provisioning, warming blocks ahead of them
+            self._start_hydration()
         return self
 
     def __exit__(self, exc_type, exc_value, trace):
         if exc_type:
             log.debug('Exception encountered in linux volume plugin context manager',
                       exc_info=(exc_type, exc_value, trace))
+        self._stop_hydration()
         if exc_type and self._config.context.get("preserve_on_error", False):
             return False
+        if self.plugin_config.get('deferred_cleanup', False) and 'id' in self.context.volume:
+            self._defer_cleanup()
+            return False
         self._detach()
         self._delete()
         return False
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.util.ec2
+=================
+EC2 utility functions
+"""
+import json
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import closing
+from time import time
+
+from bunch import bunchify
+from boto.utils import get_instance_metadata
+
+from aminator.util.linux import register_after_fork
+
+
+log = logging.getLogger(__name__)
+
+InstanceIdentity = namedtuple(
+    'InstanceIdentity',
+    'instance_id availability_zone region public_hostname local_hostname local_ipv4 block_device_mapping')
+
+_identity = None
+_identity_lock = threading.Lock()
+
+
+@register_after_fork
+def _reset_identity_lock():
+    global _identity_lock
+    _identity_lock = threading.Lock()
+
+
+# states a resource will never leave on its own
+FAILED_STATES = {
+    'Volume': ('error',),
+    'Snapshot': ('error',),
+    'Image': ('failed', 'deregistered', 'invalid'),
+}
+
+
+def instance_identity(refresh=False, timeout=None, num_retries=5):
+    """
+    the identity of the instance aminator runs on, fetched from the instance metadata
+    service once per process and cached until invalidated or refreshed
+    """
+    global _identity
+    with _identity_lock:
+        if _identity is None or refresh:
+            log.debug('Retrieving instance metadata')
+            md = get_instance_metadata(timeout=timeout, num_retries=num_retries)
+            if not md:
+                raise RuntimeError('Unable to retrieve instance metadata')
+            zone = md['placement']['availability-zone']
+            _identity = InstanceIdentity(
+                instance_id=md['instance-id'],
+                availability_zone=zone,
+                region=zone[:-1],
+                public_hostname=md.get('public-hostname'),
+                local_hostname=md.get('local-hostname'),
+                local_ipv4=md.get('local-ipv4'),
+                block_device_mapping=md.get('block-device-mapping', {}))
+        return _identity
+
+
+def invalidate_instance_identity():
+    global _identity
+    with _identity_lock:
+        _identity = None
+
+
+def resource_state(resource):
+    """ volumes and snapshots have a status, images have a state """
+    if resource.__class__.__name__ in ('Snapshot', 'Volume'):
+        return getattr(resource, 'status', None)
+    return getattr(resource, 'state', None)
+
+
+def describe_volumes(connection, ids):
+    return connection.get_all_volumes(filters={'volume-id': ids})
+
+
+def describe_snapshots(connection, ids):
+    return connection.get_all_snapshots(filters={'snapshot-id': ids})
+
+
+def describe_images(connection, ids):
+    return connection.get_all_images(filters={'image-id': ids})
+
+
+# filters rather than id lists so a resource that is not visible yet doesn't fail the whole batch
+DESCRIBE = {
+    'Volume': describe_volumes,
+    'Snapshot': describe_snapshots,
+    'Image': describe_images,
+}
+
+
+def parse_progress(progress):
+    """ snapshot progress is reported as a string such as '45%' """
+    try:
+        return float(str(progress).strip().rstrip('%'))
+    except ValueError:
+        return None
+
+
+def estimate_completion(samples, window=5):
+    """
+    estimate seconds until 100% from (timestamp, percent) samples using the rate observed
+    over the last window samples.
+    :return: seconds remaining, or None if no progress has been observed yet
+    """
+    samples = samples[-window:]
+    if len(samples) < 2:
+        return None
+    (first_time, first_pct), (last_time, last_pct) = samples[0], samples[-1]
+    if last_pct <= first_pct or last_time <= first_time:
+        return None
+    rate = (last_pct - first_pct) / (last_time - first_time)
+    return max(0.0, (100.0 - last_pct) / rate)
+
+
+class PendingResource(object):
+    def __init__(self, resource, state, interval):
+        self.resource = resource
+        self.state = state
+        self.kind = resource.__class__.__name__
+        self.reached = False
+        self.event = threading.Event()
+        self.delay = interval
+        self.next_poll = time() + interval
+        self.samples = []
+
+    def finish(self, reached):
+        self.reached = reached
+        self.event.set()
+
+
+class ResourceWaiter(object):
+    """
+    Tracks every volume, snapshot and image a process is waiting on. A single poller thread
+    issues one batched Describe* call per resource type per tick and wakes each waiting caller
+    as soon as its resource reaches the requested state. The poller exits when nothing is pending.
+
+    Snapshots are polled adaptively: the next poll is scheduled near the completion time
+    predicted from the observed progress rate, bounded by snapshot_floor and snapshot_ceiling.
+    eta_callback, if given, is called with (snapshot, seconds) whenever a new estimate is made.
+    """
+
+    # how often a waiting caller makes sure the poller is still running
+    POLLER_CHECK = 5
+
+    def __init__(self, connection, interval=1, snapshot_floor=1, snapshot_ceiling=30, eta_callback=None):
+        self._connection = connection
+        self._interval = interval
+        self._snapshot_floor = snapshot_floor
+        self._snapshot_ceiling = snapshot_ceiling
+        self._eta_callback = eta_callback
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._poller = None
+
+    def wait(self, resource, state, timeout=None):
+        """
+        block until resource reaches state. resource is updated in place.
+        :return: True if the state was reached, False on timeout or a failed state
+        """
+        if resource.__class__.__name__ not in DESCRIBE:
+            raise ValueError('Unable to wait on {0}'.format(resource.__class__.__name__))
+        pending = PendingResource(resource, state, self._interval)
+        with self._lock:
+            self._pending.append(pending)
+        deadline = None if timeout is None else time() + timeout
+        while not pending.event.is_set():
+            # restarts the poller should it have died since the last check
+            self._start_poller()
+            remaining = self.POLLER_CHECK if deadline is None else min(self.POLLER_CHECK, deadline - time())
+            if remaining <= 0:
+                break
+            pending.event.wait(remaining)
+        with self._lock:
+            if pending in self._pending:
+                self._pending.remove(pending)
+        return pending.reached
+
+    def _start_poller(self):
+        with self._lock:
+            if self._poller is None and self._pending:
+                self._poller = threading.Thread(target=self._poll, name='ec2-resource-waiter')
+                self._poller.daemon = True
+                self._poller.start()
+        self._wakeup.set()
+
+    def _poll(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        self._poller = None
+                        return
+                    pending = list(self._pending)
+                    self._wakeup.clear()
+                now = time()
+                next_poll = min(entry.next_poll for entry in pending)
+                if next_poll > now:
+                    # woken early when a new resource is registered
+                    self._wakeup.wait(next_poll - now)
+                    continue
+                for kind in DESCRIBE:
+                    entries = [entry for entry in pending if entry.kind == kind]
+                    # everything of a kind rides along once any of it is due
+                    if any(entry.next_poll <= now for entry in entries):
+                        self._check(kind, entries)
+                with self._lock:
+                    self._pending = [entry for entry in self._pending if not entry.event.is_set()]
+        except Exception:
+            log.exception('Resource waiter poller failed')
+        finally:
+            with self._lock:
+                if self._poller is threading.current_thread():
+                    self._poller = None
+
+    def _check(self, kind, entries):
+        ids = list(set(entry.resource.id for entry in entries))
+        try:
+            described = dict((obj.id, obj) for obj in DESCRIBE[kind](self._connection, ids))
+        except Exception:
+            # throttling, server and network errors alike, the next tick tries again
+            log.debug('Error describing {0}s {1}'.format(kind, ', '.join(ids)), exc_info=True)
+            described = {}
+        now = time()
+        for entry in entries:
+            entry.next_poll = now + self._interval
+            obj = described.get(entry.resource.id)
+            if obj is None:
+                log.debug('{0} {1} not visible yet'.format(kind, entry.resource.id))
+                continue
+            entry.resource._update(obj)
+            state = resource_state(entry.resource)
+            if kind == 'Snapshot':
+                log.debug('Snapshot {0} state: {1}, progress: {2}'.format(obj.id, state, obj.progress))
+            if state == entry.state:
+                entry.finish(True)
+            elif state in FAILED_STATES[kind]:
+                log.debug('{0} {1} entered failed state {2}'.format(kind, obj.id, state))
+                entry.finish(False)
+            elif kind == 'Snapshot':
+                entry.next_poll = now + self._snapshot_delay(entry, now)
+
+    def _snapshot_delay(self, entry, now):
+        progress = parse_progress(entry.resource.progress)
+        if progress is not None:
+            entry.samples.append((now, progress))
+        eta = estimate_completion(entry.samples)
+        if eta is None:
+            # no progress yet, back off gently until there is a rate to work from
+            entry.delay = min(self._snapshot_ceiling, max(self._snapshot_floor, entry.delay * 1.5))
+            return entry.delay
+        log.debug('Snapshot {0} estimated to complete in {1:.1f}s'.format(entry.resource.id, eta))
+        if self._eta_callback is not None:
+            self._eta_callback(entry.resource, eta)
+        entry.delay = min(self._snapshot_ceiling, max(self._snapshot_floor, eta))
+        return entry.delay
+
+
+def image_record(image):
+    """ the subset of a boto Image aminator uses, as a plain dict """
+    block_device_mapping = {}
+    for device, mapping in image.block_device_mapping.iteritems():
+        block_device_mapping[device] = {
+            'snapshot_id': mapping.snapshot_id,
+            'size': mapping.size,
+            'volume_type': mapping.volume_type,
+            'delete_on_termination': mapping.delete_on_termination,
+            'ephemeral_name': mapping.ephemeral_name,
+        }
+    return {
+        'id': image.id,
+        'name': image.name,
+        'root_device_name': image.root_device_name,
+        'block_device_mapping': block_device_mapping,
+        'kernel_id': image.kernel_id,
+        'ramdisk_id': image.ramdisk_id,
+        'architecture': image.architecture,
+        'virtualization_type': image.virtualization_type,
+        'tags': dict(image.tags),
+    }
+
+
+class ImageCache(object):
+    """
+    sqlite backed cache of image records, indexed by region and both id and name.
+    entries older than ttl seconds (never, if ttl is None) are stale. lookups return
+    (record, fresh) with attribute access on the record, or None on a miss.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS images ('
+        ' region TEXT NOT NULL, id TEXT NOT NULL, name TEXT, fetched REAL NOT NULL, record TEXT NOT NULL,'
+        ' PRIMARY KEY (region, id))',
+        'CREATE INDEX IF NOT EXISTS images_name ON images (region, name)',
+    )
+
+    def __init__(self, path, region, ttl=None):
+        self._path = path
+        self._region = region
+        self._ttl = ttl
+        with closing(self._connect()) as db:
+            with db:
+                for statement in self.SCHEMA:
+                    db.execute(statement)
+
+    def _connect(self):
+        # several bakes may share the cache, wait out their writes
+        return sqlite3.connect(self._path, timeout=30)
+
+    def _lookup(self, column, value):
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT fetched, record FROM images WHERE region = ? AND {0} = ? '
+                'ORDER BY fetched DESC LIMIT 1'.format(column), (self._region, value)).fetchone()
+        if row is None:
+            return None
+        fetched, record = row
+        fresh = self._ttl is None or time() - fetched < self._ttl
+        return bunchify(json.loads(record)), fresh
+
+    def by_id(self, image_id):
+        return self._lookup('id', image_id)
+
+    def by_name(self, name):
+        return self._lookup('name', name)
+
+    def put(self, records):
+        now = time()
+        with closing(self._connect()) as db:
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO images (region, id, name, fetched, record) VALUES (?, ?, ?, ?, ?)',
+                    [(self._region, record['id'], record['name'], now, json.dumps(record)) for record in records])
+        return [bunchify(record) for record in records]
+
+    def touch(self, image_id):
+        with closing(self._connect()) as db:
+            with db:
+                db.execute('UPDATE images SET fetched = ? WHERE region = ? AND id = ?', (time(), self._region, image_id))
+
+    def prefetch(self, connection, names):
+        """ populate the cache for a list of image names with a single DescribeImages call """
+        log.debug('Prefetching images {0}'.format(', '.join(names)))
+        return self.put([image_record(image) for image in connection.get_all_images(filters={'name': names})])
@@ -24,14 +24,18 @@ aminator.util.linux
 Linux utility functions
 """
 
+import ctypes
+import ctypes.util
 import errno
 import io
 import logging
 import os
 import shutil
 import stat
+import struct
 import string
 import sys
+import threading
 
 from collections import namedtuple
 from contextlib import contextmanager
@@ -41,15 +45,18 @@ from fcntl import flock as _flock
 from glob import glob
 from os import O_NONBLOCK, environ, makedirs
 from os.path import isdir, dirname
-from select import select
-from signal import signal, alarm, SIGALRM
+from select import select, poll, POLLPRI, POLLERR
+from signal import signal, alarm, SIGALRM, SIGKILL, SIGTERM
 from subprocess import Popen, PIPE
+from time import sleep, time
 
 from decorator import decorator
 
 
 log = logging.getLogger(__name__)
 MountSpec = namedtuple('MountSpec', 'dev fstype mountpoint options')
+OpenFile = namedtuple('OpenFile', 'pid command kind path')
+MountInfo = namedtuple('MountInfo', 'mount_id parent_id dev fstype mountpoint options')
 CommandResult = namedtuple('CommandResult', 'success result')
 Response = namedtuple('Response', ['command', 'std_err', 'std_out', 'status_code'])
 # need to scrub anything not in this list from AMI names and other metadata
@@ -139,10 +146,118 @@ def monitor_command(cmd, timeout=None):
     return CommandResult(status_code == 0, Response(cmdStr, std_err, std_out, status_code))
 
 
+def _unescape_mountinfo(field):
+    # spaces, tabs, newlines and backslashes in paths are octal escaped
+    return field.replace('\\040', ' ').replace('\\011', '\t').replace('\\012', '\n').replace('\\134', '\\')
+
+
+def parse_mountinfo(line):
+    """ a line of /proc/<pid>/mountinfo as a MountInfo """
+    fields, _, tail = line.partition(' - ')
+    fields = fields.split()
+    fstype, source = tail.split()[:2]
+    return MountInfo(int(fields[0]), int(fields[1]), _unescape_mountinfo(source), fstype,
+                     _unescape_mountinfo(fields[4]), fields[5])
+
+
+class MountTable(object):
+    """
+    the mounts of this process' mount namespace, parsed from mountinfo and re-read only after
+    the kernel signals a change to it (POLLPRI on the open file), rather than on every lookup.
+    mounts are indexed by mountpoint, the last one mounted on a path being the visible one
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._fh = None
+        self._poll = None
+        self._mounts = []
+        self._by_mountpoint = {}
+
+    def _changed(self):
+        if self._fh is None:
+            # mount namespaces can differ between threads, see private_mount_namespace
+            path = self._path
+            if path is None:
+                path = '/proc/thread-self/mountinfo' if os.path.exists('/proc/thread-self') else '/proc/self/mountinfo'
+            self._fh = open(path)
+            self._poll = poll()
+            self._poll.register(self._fh, POLLPRI | POLLERR)
+            return True
+        # the kernel flags the file when the namespace's mount table has changed since the last poll
+        return bool(self._poll.poll(0))
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not self._changed() and not force:
+                return
+            self._fh.seek(0)
+            self._mounts = [parse_mountinfo(line) for line in self._fh.read().splitlines() if line]
+            self._by_mountpoint = dict((entry.mountpoint, entry) for entry in self._mounts)
+
+    def close(self):
+        """ forget the open mountinfo, e.g. after switching mount namespaces """
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+            self._fh = self._poll = None
+
+    def get(self, mountpoint):
+        self.refresh()
+        return self._by_mountpoint.get(os.path.normpath(mountpoint.strip()))
+
+    def is_mounted(self, mountpoint):
+        return self.get(mountpoint) is not None
+
+    def under(self, root):
+        """ mountpoints at root and below, in the order they were mounted """
+        self.refresh()
+        root = os.path.normpath(root)
+        prefix = root.rstrip('/') + '/'
+        return [entry.mountpoint for entry in self._mounts
+                if entry.mountpoint == root or entry.mountpoint.startswith(prefix)]
+
+
+_mount_table = None
+
+# run in daemonize's child to replace state, locks above all, that other threads of the
+# parent may have held when it forked. those threads don't exist in the child, so their
+# locks would never be released
+_after_fork = []
+
+
+def register_after_fork(func):
+    """ have daemonize run func in the child it forks """
+    _after_fork.append(func)
+    return func
+
+
+@register_after_fork
+def _reset_mount_table():
+    global _mount_table
+    _mount_table = None
+
+
+@register_after_fork
+def _reset_logging_locks():
+    logging._lock = threading.RLock()
+    for handler in logging._handlerList:
+        handler = handler()
+        if handler is not None:
+            handler.createLock()
+
+
+def mount_table():
+    """ the process-wide MountTable """
+    global _mount_table
+    if _mount_table is None:
+        _mount_table = MountTable()
+    return _mount_table
+
+
 def mounted(mountspec):
-    pat = mountspec.mountpoint.strip() + ' '
-    with open('/proc/mounts') as mounts:
-        return any(pat in mount for mount in mounts)
+    return mount_table().is_mounted(mountspec.mountpoint)
 
 
 def fsck(dev):
@@ -168,66 +283,463 @@ def growpart(dev, part):
     return cmd
 
 
-def mount(mountspec):
-    if not any((mountspec.dev, mountspec.mountpoint)):
-        log.error('Must provide dev or mountpoint')
+def losetup(dev, path):
+    # scan for partitions so partitioned images get /dev/loopNpM nodes
+    return monitor_command(['losetup', '-P', dev, path])
+
+
+def losetup_detach(dev):
+    return monitor_command(['losetup', '-d', dev])
+
+
+def loop_backing_file(dev):
+    """ the file backing loop device dev, or None if it is not attached """
+    try:
+        with open('/sys/block/{0}/loop/backing_file'.format(os.path.basename(dev))) as backing_file:
+            return backing_file.read().strip()
+    except IOError:
         return None
 
-    fstype_arg = options_arg = None
 
-    mountpoint = mountspec.mountpoint
+def sparse_copy(src, dst):
+    """ copy an image file, sharing extents where the filesystem supports it and keeping holes otherwise """
+    return monitor_command(['cp', '--sparse=always', '--reflink=auto', src, dst])
+
 
+def block_copy(src, dst):
+    """
+    copy between block devices and image files, skipping runs of zeros. the destination
+    must read as zeros already, e.g. a new file or a freshly created EBS volume
+    """
+    return monitor_command(['dd', 'if={0}'.format(src), 'of={0}'.format(dst), 'bs=1M', 'conv=sparse,fsync'])
+
+
+def device_size(dev):
+    """ size in bytes of a block device or file """
+    fd = os.open(dev, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXT_FEATURE_COMPAT_HAS_JOURNAL = 0x4
+EXT_FEATURE_INCOMPAT_EXTENTS = 0x40
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+EXT_FEATURE_INCOMPAT_FLEX_BG = 0x200
+XFS_MAGIC = 'XFSB'
+BTRFS_SUPERBLOCK_OFFSET = 0x10000
+BTRFS_MAGIC = '_BHRfS_M'
+
+
+def _read_at(fh, offset, size):
+    fh.seek(offset)
+    return fh.read(size)
+
+
+def probe_filesystem(dev):
+    """
+    identify the filesystem on dev from its superblock, blkid style, without running anything
+    :return: (fstype, size in bytes), or (None, None) if not ext2/3/4, xfs or btrfs
+    """
+    try:
+        with open(dev, 'rb') as fh:
+            superblock = _read_at(fh, 0, 512)
+            if superblock[:4] == XFS_MAGIC:
+                block_size, data_blocks = struct.unpack_from('>IQ', superblock, 4)
+                return 'xfs', block_size * data_blocks
+            superblock = _read_at(fh, EXT_SUPERBLOCK_OFFSET, 1024)
+            if len(superblock) == 1024 and struct.unpack_from('<H', superblock, 0x38)[0] == EXT_MAGIC:
+                blocks, = struct.unpack_from('<I', superblock, 0x04)
+                log_block_size, = struct.unpack_from('<I', superblock, 0x18)
+                compat, incompat = struct.unpack_from('<II', superblock, 0x5C)
+                if incompat & EXT_FEATURE_INCOMPAT_64BIT:
+                    blocks |= struct.unpack_from('<I', superblock, 0x150)[0] << 32
+                if incompat & (EXT_FEATURE_INCOMPAT_EXTENTS | EXT_FEATURE_INCOMPAT_64BIT | EXT_FEATURE_INCOMPAT_FLEX_BG):
+                    fstype = 'ext4'
+                elif compat & EXT_FEATURE_COMPAT_HAS_JOURNAL:
+                    fstype = 'ext3'
+                else:
+                    fstype = 'ext2'
+                return fstype, blocks * (1024 << log_block_size)
+            superblock = _read_at(fh, BTRFS_SUPERBLOCK_OFFSET, 0x78)
+            if superblock[0x40:0x48] == BTRFS_MAGIC:
+                return 'btrfs', struct.unpack_from('<Q', superblock, 0x70)[0]
+    except IOError:
+        log.debug('Unable to read superblock of {0}'.format(dev), exc_info=True)
+    return None, None
+
+
+def grow_filesystem(fstype, dev, mountpoint):
+    """ grow the filesystem on dev, mounted at mountpoint, to fill its device """
+    if fstype in ('ext2', 'ext3', 'ext4'):
+        # online when mounted
+        return resize2fs(dev)
+    if fstype == 'xfs':
+        return monitor_command(['xfs_growfs', mountpoint])
+    if fstype == 'btrfs':
+        return monitor_command(['btrfs', 'filesystem', 'resize', 'max', mountpoint])
+    raise ValueError('Unable to grow {0} filesystem on {1}'.format(fstype, dev))
+
+
+def ext_used_extents(dev):
+    """
+    byte ranges of dev holding allocated blocks of its ext2/3/4 filesystem, from the block
+    bitmaps dumpe2fs reports
+    :return: list of (offset, length), or None if dev does not hold an ext filesystem
+    """
+    dump = monitor_command(['dumpe2fs', dev])
+    if not dump.success:
+        return None
+    block_size = block_count = None
+    free = []
+    for line in dump.result.std_out.splitlines():
+        if line.startswith('Block size:'):
+            block_size = int(line.split(':', 1)[1])
+        elif line.startswith('Block count:'):
+            block_count = int(line.split(':', 1)[1])
+        elif line.strip().startswith('Free blocks:') and line.startswith(' '):
+            for extent in line.split(':', 1)[1].split(','):
+                extent = extent.strip()
+                if not extent:
+                    continue
+                first, _, last = extent.partition('-')
+                free.append((int(first), int(last or first)))
+    if not (block_size and block_count):
+        return None
+    used = []
+    block = 0
+    for first, last in sorted(free):
+        if first > block:
+            used.append((block * block_size, (first - block) * block_size))
+        block = max(block, last + 1)
+    if block < block_count:
+        used.append((block * block_size, (block_count - block) * block_size))
+    return used
+
+
+def read_extents(dev, extents, readers=8, chunk_size=1024 * 1024, stop=None):
+    """
+    read the given (offset, length) byte ranges of dev with parallel readers, in chunk_size
+    reads aligned to chunk_size, discarding the data. used to pull lazily loaded blocks in
+    ahead of use. stop, a threading.Event, ends the reads early when set
+    :return: number of bytes read
+    """
+    chunks = []
+    for offset, length in extents:
+        start = offset - offset % chunk_size
+        while start < offset + length:
+            # adjacent extents often share a chunk
+            if not chunks or chunks[-1] < start:
+                chunks.append(start)
+            start += chunk_size
+    lock = threading.Lock()
+    position = [0]
+    totals = []
+
+    def reader():
+        total = 0
+        fd = os.open(dev, os.O_RDONLY)
+        try:
+            while stop is None or not stop.is_set():
+                with lock:
+                    if position[0] >= len(chunks):
+                        break
+                    chunk = chunks[position[0]]
+                    position[0] += 1
+                os.lseek(fd, chunk, os.SEEK_SET)
+                total += len(os.read(fd, chunk_size))
+        finally:
+            os.close(fd)
+            with lock:
+                totals.append(total)
+
+    threads = [threading.Thread(target=reader, name='read-extents-{0}'.format(i)) for i in xrange(readers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(totals)
+
+
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_SYNCHRONOUS = 16
+MS_REMOUNT = 32
+MS_DIRSYNC = 128
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_REC = 16384
+MS_UNBINDABLE = 1 << 17
+MS_PRIVATE = 1 << 18
+MS_SLAVE = 1 << 19
+MS_SHARED = 1 << 20
+MS_RELATIME = 1 << 21
+MS_STRICTATIME = 1 << 24
+MNT_DETACH = 2
+
+MOUNT_FLAGS = {
+    'defaults': 0, 'rw': 0, 'suid': 0, 'dev': 0, 'exec': 0, 'async': 0,
+    'ro': MS_RDONLY, 'nosuid': MS_NOSUID, 'nodev': MS_NODEV, 'noexec': MS_NOEXEC,
+    'sync': MS_SYNCHRONOUS, 'remount': MS_REMOUNT, 'dirsync': MS_DIRSYNC,
+    'noatime': MS_NOATIME, 'nodiratime': MS_NODIRATIME, 'relatime': MS_RELATIME,
+    'strictatime': MS_STRICTATIME, 'bind': MS_BIND, 'rbind': MS_BIND | MS_REC,
+}
+# propagation can only be changed on its own, after the mount exists
+PROPAGATION_FLAGS = {
+    'private': MS_PRIVATE, 'rprivate': MS_PRIVATE | MS_REC,
+    'slave': MS_SLAVE, 'rslave': MS_SLAVE | MS_REC,
+    'shared': MS_SHARED, 'rshared': MS_SHARED | MS_REC,
+    'unbindable': MS_UNBINDABLE, 'runbindable': MS_UNBINDABLE | MS_REC,
+}
+
+
+def mount_flags(fstype, options):
+    """
+    split mount(8) style fstype and options into mount(2) flags, propagation flags and
+    the filesystem specific data string
+    """
+    flags = propagation = 0
+    data = []
+    if fstype == 'bind':
+        flags |= MS_BIND
+    for option in (options or '').split(','):
+        option = option.strip()
+        if not option:
+            continue
+        if option in MOUNT_FLAGS:
+            flags |= MOUNT_FLAGS[option]
+        elif option in PROPAGATION_FLAGS:
+            propagation |= PROPAGATION_FLAGS[option]
+        else:
+            data.append(option)
+    return flags, propagation, ','.join(data) or None
+
+
+def _syscall_result(cmd, ret):
+    if ret == 0:
+        return CommandResult(True, Response(cmd, '', '', 0))
+    err = ctypes.get_errno()
+    log.debug('{0} failed: {1}'.format(cmd, os.strerror(err)))
+    return CommandResult(False, Response(cmd, os.strerror(err), '', err))
+
+
+def _mount_syscall(mountspec):
+    """ mount(2) equivalent of _mount_command, None when it has to be left to mount(8) """
+    flags, propagation, data = mount_flags(mountspec.fstype, mountspec.options)
+    fstype = mountspec.fstype
+    if flags & MS_BIND:
+        fstype = None
+    elif not fstype and not flags & MS_REMOUNT:
+        # mount(8) would ask blkid
+        fstype = probe_filesystem(mountspec.dev)[0]
+        if fstype is None:
+            return None
+    cmd = 'mount({0}, {1}, {2}, {3:#x}, {4})'.format(mountspec.dev, mountspec.mountpoint, fstype, flags, data)
+    log.debug('command: {0}'.format(cmd))
+    # the kernel ignores ro, nosuid and the like when binding, they take a remount of the bind
+    bind_flags = flags & ~(MS_BIND | MS_REC) if flags & MS_BIND and not flags & MS_REMOUNT else 0
+    result = _syscall_result(cmd, libc().mount(mountspec.dev, mountspec.mountpoint, fstype,
+                                               flags & ~bind_flags, data))
+    if result.success and bind_flags:
+        result = _syscall_result(cmd, libc().mount(None, mountspec.mountpoint, None,
+                                                   MS_REMOUNT | MS_BIND | bind_flags, None))
+    if result.success and propagation:
+        result = _syscall_result(cmd, libc().mount(None, mountspec.mountpoint, None, propagation, None))
+    return result
+
+
+def _mount_command(mountspec):
+    cmd = ['mount']
     if mountspec.fstype:
         if mountspec.fstype == 'bind':
-            fstype_flag = '-o'
-            # we may need to create the mountpoint if it does not exist
-            if not isdir(mountspec.dev):
-                mountpoint = dirname(mountspec.mountpoint)
+            cmd.extend(['-o', 'bind'])
         else:
-            fstype_flag = '-t'
-        fstype_arg = '{0} {1}'.format(fstype_flag, mountspec.fstype)
+            cmd.extend(['-t', mountspec.fstype])
+    if mountspec.options:
+        cmd.extend(['-o', mountspec.options])
+    cmd.extend([mountspec.dev, mountspec.mountpoint])
+    return monitor_command(cmd)
+
+
+def mount(mountspec, backend='command'):
+    """
+    mount mountspec with mount(8), or with the mount(2) syscall if backend is 'syscall'.
+    the syscall backend falls back to mount(8) for anything it cannot do itself
+    """
+    if not any((mountspec.dev, mountspec.mountpoint)):
+        log.error('Must provide dev or mountpoint')
+        return None
+
+    mountpoint = mountspec.mountpoint
+
+    if mountspec.fstype == 'bind':
+        # we may need to create the mountpoint if it does not exist
+        if not isdir(mountspec.dev):
+            mountpoint = dirname(mountspec.mountpoint)
 
     if not isdir(mountpoint):
         makedirs(mountpoint)
 
-    if mountspec.options:
-        options_arg = '-o ' + mountspec.options
+    if backend == 'syscall':
+        result = _mount_syscall(mountspec)
+        if result is not None:
+            return result
+        log.debug('Falling back to mount(8) for {0}'.format(mountspec))
+    return _mount_command(mountspec)
 
-    cmd = ['mount']
-    if fstype_arg is not None:
-        cmd.append(fstype_arg)
-    if options_arg is not None:
-        cmd.append(options_arg)
-    cmd.extend([mountspec.dev, mountspec.mountpoint])
-    return monitor_command(' '.join(cmd))
 
-
-def unmount(mountspec, verbose=True, recursive=False):
+def unmount(mountspec, verbose=True, recursive=False, lazy=False, backend='command'):
+    """
+    unmount mountspec with umount(8), or with the umount2(2) syscall if backend is 'syscall'.
+    lazy detaches the mount now and lets the kernel finish once it is no longer busy
+    """
+    if backend == 'syscall':
+        flags = MNT_DETACH if lazy else 0
+        mountpoints = lifo_mounts(mountspec.mountpoint) if recursive else [mountspec.mountpoint]
+        result = CommandResult(True, Response('umount2', '', '', 0))
+        for mountpoint in mountpoints:
+            cmd = 'umount2({0}, {1:#x})'.format(mountpoint, flags)
+            log.debug('command: {0}'.format(cmd))
+            result = _syscall_result(cmd, libc().umount2(mountpoint, flags))
+            if not result.success:
+                break
+        return result
     cmd = ['umount']
     if verbose:
         cmd.append('--verbose')
     if recursive:
         cmd.append('--recursive')
+    if lazy:
+        cmd.append('--lazy')
     cmd.append(mountspec.mountpoint)
     return monitor_command(cmd)
 
 
+def _under(path, root):
+    if path.endswith(' (deleted)'):
+        path = path[:-len(' (deleted)')]
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+
+def _readlink(path):
+    try:
+        return os.readlink(path)
+    except OSError:
+        # gone, or a kernel thread
+        return None
+
+
+def _process_command(pid):
+    try:
+        with open('/proc/{0}/comm'.format(pid)) as comm:
+            return comm.read().strip()
+    except IOError:
+        return None
+
+
+def _process_files(pid):
+    """ (kind, path) of everything process pid holds open, lsof style """
+    proc = '/proc/{0}'.format(pid)
+    for kind in ('cwd', 'root', 'exe'):
+        path = _readlink(os.path.join(proc, kind))
+        if path is not None:
+            yield kind, path
+    try:
+        fds = os.listdir(os.path.join(proc, 'fd'))
+    except OSError:
+        fds = []
+    for fd in fds:
+        path = _readlink(os.path.join(proc, 'fd', fd))
+        if path is not None:
+            yield fd, path
+    mapped = set()
+    try:
+        with open(os.path.join(proc, 'maps')) as maps:
+            for line in maps:
+                fields = line.split(None, 5)
+                # anonymous mappings have no path, [heap] and friends are not files
+                if len(fields) == 6 and fields[5].startswith('/'):
+                    mapped.add(fields[5].strip())
+    except IOError:
+        pass
+    for path in mapped:
+        yield 'mem', path
+
+
+def open_files(mountpoint):
+    """
+    what lsof would report for mountpoint, found by walking /proc: processes whose cwd,
+    root, executable, open descriptors or memory mappings are at or below mountpoint
+    :return: list of OpenFile
+    """
+    mountpoint = os.path.normpath(mountpoint)
+    found = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        for kind, path in _process_files(pid):
+            if _under(path, mountpoint):
+                found.append(OpenFile(int(pid), _process_command(pid), kind, path))
+    return found
+
+
 def busy_mount(mountpoint):
-    lsof = monitor_command(['lsof', '-X', mountpoint])
-    # lsof against a bind-mounted /dev will show open handles against /dev
-    # so filter such that we only return open handles explicitly containing
-    # the mountpoint
-    if not lsof.success or len(lsof.result.std_out) == 0:
-        return lsof
-    stdout_lines = lsof.result.std_out.split('\n')
-    header = stdout_lines[0]
-    filtered_lines = [line for line in stdout_lines if mountpoint in line]
-    new_success = len(filtered_lines) > 0
-    new_out = '\n'.join([header] + filtered_lines)
-    # repackage the response
-    resp = Response(
-        lsof.result.command, lsof.result.std_err, new_out, lsof.result.status_code)
-    return CommandResult(new_success, resp)
+    """ open files under mountpoint as a CommandResult, successful if there are any """
+    files = open_files(mountpoint)
+    lines = ['COMMAND PID FD NAME']
+    lines.extend('{0.command} {0.pid} {0.kind} {0.path}'.format(entry) for entry in files)
+    return CommandResult(len(files) > 0, Response('open_files {0}'.format(mountpoint), '', '\n'.join(lines), 0))
+
+
+def chroot_processes(root):
+    """ pids of the processes running chrooted at or below root """
+    root = os.path.normpath(root)
+    pids = []
+    for pid in os.listdir('/proc'):
+        if pid.isdigit() and int(pid) != os.getpid():
+            path = _readlink('/proc/{0}/root'.format(pid))
+            if path is not None and _under(path, root):
+                pids.append(int(pid))
+    return pids
+
+
+def kill_chroot_processes(root, timeout=5):
+    """
+    terminate the processes left running in the chroot at root, killing those still around
+    after timeout seconds
+    :return: the pids that were signalled
+    """
+    pids = chroot_processes(root)
+    if not pids:
+        return pids
+    log.warning('Terminating processes left in chroot {0}: {1}'.format(root, ', '.join(str(pid) for pid in pids)))
+    for pid in pids:
+        try:
+            os.kill(pid, SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    deadline = time() + timeout
+    remaining = pids
+    while remaining and time() < deadline:
+        sleep(0.1)
+        # zombies have no root left to read
+        remaining = [pid for pid in remaining if _readlink('/proc/{0}/root'.format(pid)) is not None]
+    for pid in remaining:
+        log.warning('Killing process {0} in chroot {1}'.format(pid, root))
+        try:
+            os.kill(pid, SIGKILL)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    return pids
 
 
 def sanitize_metadata(word):
@@ -288,14 +800,8 @@ class Chroot(object):
 
 def lifo_mounts(root):
     """return list of mount points mounted on 'root'
-    and below in lifo order from /proc/mounts."""
-    with open('/proc/mounts') as proc_mounts:
-        # grab the mountpoint for each mount where we MIGHT match
-        mount_entries = [line.split(' ')[1] for line in proc_mounts if root in line]
-    if not mount_entries:
-        # return an empty list if we didn't match
-        return mount_entries
-    return [entry for entry in reversed(mount_entries) if entry == root or entry.startswith(root + '/')]
+    and below in lifo order from the mount table."""
+    return list(reversed(mount_table().under(root)))
 
 
 def copy_image(src=None, dst=None):
@@ -357,6 +863,35 @@ def locked(filename=None):
     return ret
 
 
+def daemonize(func, *args, **kwargs):
+    """
+    run func(*args, **kwargs) in a detached grandchild process (double fork, new session)
+    and return in the parent as soon as the intermediate child has exited. File descriptors,
+    and any flocks held on them, are inherited by the daemon. Only the forking thread lives
+    on in the daemon, module state guarded by locks is renewed by the functions registered
+    with register_after_fork before func runs.
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        for after_fork in _after_fork:
+            after_fork()
+        func(*args, **kwargs)
+    except Exception:
+        log.exception('Daemonized {0} failed'.format(getattr(func, '__name__', func)))
+        os._exit(1)
+    os._exit(0)
+
+
 def root_check():
     """
     Simple root gate
@@ -452,6 +987,127 @@ def os_node_exists(dev):
     return stat.S_ISBLK(mode)
 
 
+_libc = None
+
+
+def libc():
+    """ the C library, loaded on first use, with errno captured for ctypes calls """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def wait_for_node(dev, exists=True, timeout=30):
+    """
+    wait for block device node dev to appear (or disappear, if exists is False), waking on
+    inotify events for its directory rather than polling. udev symlinks such as the xvd names
+    of NVMe devices are created in the same directory and are followed like os_node_exists does
+    :return: True if the node reached the requested state within timeout, False otherwise,
+    including when inotify is unavailable
+    """
+    try:
+        fd = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (AttributeError, OSError):
+        log.debug('inotify unavailable', exc_info=True)
+        return os_node_exists(dev) == exists
+    if fd < 0:
+        log.debug('inotify_init1 failed: {0}'.format(os.strerror(ctypes.get_errno())))
+        return os_node_exists(dev) == exists
+    try:
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM | IN_ATTRIB
+        if libc().inotify_add_watch(fd, dirname(dev) or '/', mask) < 0:
+            log.debug('inotify_add_watch on {0} failed: {1}'.format(dirname(dev), os.strerror(ctypes.get_errno())))
+            return os_node_exists(dev) == exists
+        # watch first, then check, so an event between the two is not lost
+        deadline = time() + timeout
+        while os_node_exists(dev) != exists:
+            remaining = deadline - time()
+            if remaining <= 0:
+                log.debug('Timed out waiting for {0} to {1}'.format(dev, 'appear' if exists else 'disappear'))
+                return False
+            if select([fd], [], [], remaining)[0]:
+                # the events only wake us, the node itself is the source of truth
+                try:
+                    os.read(fd, 4096)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        return True
+    finally:
+        os.close(fd)
+
+
+CLONE_NEWNS = 0x00020000
+
+
+def _own_mount_namespace():
+    return '/proc/thread-self/ns/mnt' if os.path.exists('/proc/thread-self') else '/proc/self/ns/mnt'
+
+
+def mount_namespace():
+    """ identifies the calling thread's mount namespace without holding a reference to it """
+    ns = os.stat(_own_mount_namespace())
+    return ns.st_dev, ns.st_ino
+
+
+def private_mount_namespace():
+    """
+    move the calling thread into a private copy of its mount namespace, with propagation
+    from it turned off, so mounts made from here on (and by children spawned from this thread)
+    are invisible to the rest of the host. the kernel unmounts all of them once nothing is
+    left in the namespace
+    :return: a descriptor for the previous namespace, for leave_mount_namespace
+    """
+    fd = os.open(_own_mount_namespace(), os.O_RDONLY)
+    try:
+        if libc().unshare(CLONE_NEWNS) != 0:
+            raise OSError(ctypes.get_errno(), 'unshare: {0}'.format(os.strerror(ctypes.get_errno())))
+        if libc().mount(None, '/', None, MS_REC | MS_PRIVATE, None) != 0:
+            err = ctypes.get_errno()
+            libc().setns(fd, CLONE_NEWNS)
+            raise OSError(err, 'making / private: {0}'.format(os.strerror(err)))
+    except Exception:
+        os.close(fd)
+        raise
+    mount_table().close()
+    return fd
+
+
+def mount_namespace_pids(namespace):
+    """ pids of the processes in namespace, as returned by mount_namespace """
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            member = os.stat('/proc/{0}/ns/mnt'.format(pid))
+        except OSError:
+            continue
+        if (member.st_dev, member.st_ino) == namespace:
+            pids.append(int(pid))
+    return pids
+
+
+def leave_mount_namespace(fd):
+    """ return to the namespace private_mount_namespace was called from and close its descriptor """
+    try:
+        if libc().setns(fd, CLONE_NEWNS) != 0:
+            raise OSError(ctypes.get_errno(), 'setns: {0}'.format(os.strerror(ctypes.get_errno())))
+    finally:
+        os.close(fd)
+    mount_table().close()
+
+
 def install_provision_config(src, dstpath, backup_ext='_aminator'):
     if os.path.isfile(src) or os.path.isdir(src):
         log.debug('Copying {0} from the aminator host to {1}'.format(src, dstpath))
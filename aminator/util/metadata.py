@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.util.metadata
+======================
+freshness tracking for package repository metadata, and a host-wide cache of it
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from glob import glob
+from time import time
+
+from aminator.util.linux import flock, mkdir_p
+from aminator.util.pkgcache import file_digest
+
+
+log = logging.getLogger(__name__)
+
+
+def metadata_files(root, patterns):
+    """ the files matching patterns (absolute within root) below root """
+    files = []
+    for pattern in patterns:
+        files.extend(glob(os.path.join(root, pattern.lstrip('/'))))
+    return sorted(set(files))
+
+
+def metadata_age(files):
+    """
+    seconds since the least recently touched of files, None if there are none. only stamps
+    written at refresh time tell when metadata was fetched: downloaded indexes carry the
+    repository's Last-Modified time instead
+    """
+    mtimes = []
+    for path in files:
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            return None
+    if not mtimes:
+        return None
+    return max(0, time() - min(mtimes))
+
+
+def is_fresh(files, ttl):
+    age = metadata_age(files)
+    return age is not None and age < ttl
+
+
+def touch_stamp(path):
+    """ record a successful metadata refresh """
+    mkdir_p(os.path.dirname(path))
+    with open(path, 'a'):
+        os.utime(path, None)
+
+
+def is_refreshed(stamp, indexes, ttl):
+    """ whether stamp was touched within ttl seconds, and the indexes it vouches for exist """
+    return bool(indexes) and is_fresh([stamp], ttl)
+
+
+def configuration_key(root, patterns):
+    """ a digest of the repository configuration files below root, e.g. sources.list """
+    digest = hashlib.sha256()
+    for path in metadata_files(root, patterns):
+        digest.update(os.path.relpath(path, root))
+        digest.update(file_digest(path))
+    return digest.hexdigest()
+
+
+class MetadataCache(object):
+    """
+    a copy of a package manager's repository metadata per repository configuration, refreshed
+    by one bake at most every ttl seconds and copied into the chroot by the others. each entry
+    records when it was refreshed and the checksums of its release files, so a refresh that
+    brought nothing new does not rewrite the copy
+    """
+
+    def __init__(self, path, ttl):
+        self._path = path
+        self._ttl = ttl
+        mkdir_p(path)
+
+    def _entry(self, key):
+        return os.path.join(self._path, key)
+
+    def lock(self, key):
+        """ held while checking, refreshing and exporting an entry, so a stale entry is refreshed once """
+        return flock(os.path.join(self._path, '{0}.lock'.format(key)))
+
+    def _manifest(self, key):
+        try:
+            with open(os.path.join(self._entry(key), 'manifest.json')) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def fresh(self, key):
+        manifest = self._manifest(key)
+        return manifest is not None and time() - manifest['refreshed'] < self._ttl
+
+    def seed(self, key, dst):
+        """ replace the metadata in dst with the cached copy """
+        src = os.path.join(self._entry(key), 'data')
+        log.debug('Seeding {0} from {1}'.format(dst, src))
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst, symlinks=True)
+
+    def export(self, key, src, release_files):
+        """
+        record the metadata in src as refreshed now. release_files are the files below src whose
+        checksums identify its content
+        """
+        entry = self._entry(key)
+        checksums = dict((os.path.relpath(path, src), file_digest(path)) for path in release_files)
+        manifest = self._manifest(key)
+        if manifest is None or manifest['checksums'] != checksums:
+            log.debug('Exporting {0} to {1}'.format(src, entry))
+            mkdir_p(entry)
+            staging = tempfile.mkdtemp(dir=entry, prefix='data.')
+            os.rmdir(staging)
+            shutil.copytree(src, staging, symlinks=True)
+            data = os.path.join(entry, 'data')
+            previous = '{0}.old'.format(staging)
+            try:
+                os.rename(data, previous)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            os.rename(staging, data)
+            shutil.rmtree(previous, ignore_errors=True)
+        else:
+            log.debug('Metadata in {0} unchanged'.format(entry))
+        manifest_path = os.path.join(entry, 'manifest.json')
+        with open('{0}.tmp'.format(manifest_path), 'w') as fh:
+            json.dump({'refreshed': time(), 'checksums': checksums}, fh)
+        os.rename('{0}.tmp'.format(manifest_path), manifest_path)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.util.pkgcache
+======================
+host-wide, content-addressed cache of downloaded packages shared by concurrent bakes
+"""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import closing
+from time import time
+
+from aminator.util.linux import flock, mkdir_p
+from aminator.util.slots import process_alive, process_starttime
+
+
+log = logging.getLogger(__name__)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PackageCache(object):
+    """
+    packages are stored once per content digest under objects/ and indexed by their path
+    relative to the package manager's cache directory. a bake gets a stage directory seeded
+    with hard links to every cached package, which is bind mounted over the package manager's
+    cache in the chroot, and harvested for newly downloaded packages afterwards. hard links
+    keep seeded packages intact for in-flight bakes while others evict them. an object whose
+    mtime changed since it was harvested, rewritten in place through a link, is checked against
+    its digest before it is seeded again, and dropped if it no longer matches.
+
+    the cache is kept under max_size bytes by evicting the least recently used packages.
+    use is taken from the object's access time where the filesystem maintains it, so packages
+    read by a package manager count as used, and from the harvest time otherwise
+    """
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS packages (name TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)',
+              'CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, mtime REAL NOT NULL)')
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        self._objects = os.path.join(path, 'objects')
+        self._stages = os.path.join(path, 'stage')
+        mkdir_p(self._objects)
+        mkdir_p(self._stages)
+        with closing(self._connect()) as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    def _connect(self):
+        # autocommit mode, transactions are explicit
+        return sqlite3.connect(os.path.join(self._path, 'index.sqlite'), timeout=60, isolation_level=None)
+
+    def _lock(self):
+        return flock(os.path.join(self._path, 'lock'))
+
+    def _object(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def stage(self, subdirs=()):
+        """
+        a new stage directory seeded with the cached packages, plus any subdirs the package
+        manager expects to find
+        :return: (path of the stage directory, number of packages seeded)
+        """
+        self._reap_stages()
+        pid = os.getpid()
+        stage = tempfile.mkdtemp(dir=self._stages, prefix='{0}.{1}.'.format(pid, process_starttime(pid)))
+        for subdir in subdirs:
+            mkdir_p(os.path.join(stage, subdir.strip('/')))
+        with closing(self._connect()) as db:
+            packages = db.execute('SELECT packages.name, packages.digest, objects.mtime FROM packages '
+                                  'LEFT JOIN objects ON objects.digest = packages.digest').fetchall()
+        seeded = 0
+        intact = set()
+        corrupted = set()
+        reverified = {}
+        for name, digest, mtime in packages:
+            if digest not in intact and digest not in corrupted:
+                current = self._verify(digest, mtime)
+                if current is False:
+                    corrupted.add(digest)
+                elif current is not None:
+                    intact.add(digest)
+                    if current != mtime:
+                        reverified[digest] = current
+            if digest not in intact:
+                continue
+            target = os.path.join(stage, name)
+            mkdir_p(os.path.dirname(target))
+            try:
+                os.link(self._object(digest), target)
+            except OSError as e:
+                # evicted since the index was read
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                seeded += 1
+        if reverified or corrupted:
+            self._record(reverified, corrupted)
+        log.debug('Seeded {0} with {1} cached packages'.format(stage, seeded))
+        return stage, seeded
+
+    def _verify(self, digest, mtime):
+        """
+        the object's mtime if it still holds digest, False if it does not, None if it is gone.
+        an object whose mtime is the recorded one is trusted without reading it
+        """
+        try:
+            current = os.stat(self._object(digest)).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if current == mtime or file_digest(self._object(digest)) == digest:
+            return current
+        log.warning('Cached package object {0} was modified, dropping it'.format(digest))
+        return False
+
+    def _record(self, reverified, corrupted):
+        """ record the mtimes of reverified objects and drop the corrupted ones """
+        with self._lock():
+            with closing(self._connect()) as db:
+                for digest, mtime in reverified.iteritems():
+                    db.execute('INSERT OR REPLACE INTO objects (digest, mtime) VALUES (?, ?)', (digest, mtime))
+                for digest in corrupted:
+                    db.execute('DELETE FROM packages WHERE digest = ?', (digest,))
+                    self._drop(db, digest)
+
+    def _reap_stages(self):
+        """ remove stages left behind by bakes that died before harvesting them """
+        for stage in os.listdir(self._stages):
+            try:
+                pid, starttime = [int(field) for field in stage.split('.')[:2]]
+            except ValueError:
+                continue
+            if not process_alive(pid, starttime):
+                log.debug('Removing abandoned package cache stage {0}'.format(stage))
+                shutil.rmtree(os.path.join(self._stages, stage), ignore_errors=True)
+
+    def harvest(self, stage, extension):
+        """
+        add the packages downloaded into stage to the cache, then remove stage
+        :return: the number of packages added
+        """
+        suffix = '.{0}'.format(extension.lstrip('.'))
+        added = 0
+        with self._lock():
+            with closing(self._connect()) as db:
+                known = dict(db.execute('SELECT name, digest FROM packages').fetchall())
+                for root, dirs, files in os.walk(stage):
+                    for filename in files:
+                        if not filename.endswith(suffix):
+                            continue
+                        path = os.path.join(root, filename)
+                        name = os.path.relpath(path, stage)
+                        if name in known and self._is_object(path, known[name]):
+                            # seeded, not downloaded
+                            continue
+                        digest = file_digest(path)
+                        obj = self._object(digest)
+                        mkdir_p(os.path.dirname(obj))
+                        try:
+                            os.link(path, obj)
+                        except OSError as e:
+                            if e.errno != errno.EEXIST:
+                                raise
+                        stat = os.stat(obj)
+                        db.execute('INSERT OR REPLACE INTO packages (name, digest, size, used) VALUES (?, ?, ?, ?)',
+                                   (name, digest, stat.st_size, time()))
+                        db.execute('INSERT OR REPLACE INTO objects (digest, mtime) VALUES (?, ?)', (digest, stat.st_mtime))
+                        if known.get(name, digest) != digest:
+                            # a new version under the same name
+                            self._drop(db, known[name])
+                        added += 1
+                self._evict(db)
+        shutil.rmtree(stage, ignore_errors=True)
+        log.debug('Harvested {0} new packages from {1}'.format(added, stage))
+        return added
+
+    def _is_object(self, path, digest):
+        try:
+            return os.path.samefile(path, self._object(digest))
+        except OSError:
+            return False
+
+    def _last_used(self, digest, used):
+        try:
+            return max(used, os.stat(self._object(digest)).st_atime)
+        except OSError:
+            return used
+
+    def _drop(self, db, digest):
+        """ remove the object for digest unless a package still refers to it """
+        if db.execute('SELECT 1 FROM packages WHERE digest = ?', (digest,)).fetchone():
+            return
+        db.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+        try:
+            os.unlink(self._object(digest))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _remove_orphans(self, db):
+        """ remove objects no package refers to, left by harvests that died midway """
+        referenced = set(digest for (digest,) in db.execute('SELECT DISTINCT digest FROM packages'))
+        for prefix in os.listdir(self._objects):
+            for digest in os.listdir(os.path.join(self._objects, prefix)):
+                if digest not in referenced:
+                    log.debug('Removing unreferenced package object {0}'.format(digest))
+                    self._drop(db, digest)
+
+    def _evict(self, db):
+        """ drop the least recently used packages until the cache fits in max_size """
+        self._remove_orphans(db)
+        packages = db.execute('SELECT name, digest, size, used FROM packages').fetchall()
+        sizes = dict((digest, size) for name, digest, size, used in packages)
+        total = sum(sizes.itervalues())
+        if total <= self._max_size:
+            return
+        referenced = {}
+        for name, digest, size, used in packages:
+            referenced.setdefault(digest, set()).add(name)
+        for name, digest, size, used in sorted(packages, key=lambda package: self._last_used(package[1], package[3])):
+            if total <= self._max_size:
+                break
+            log.debug('Evicting {0} from the package cache'.format(name))
+            db.execute('DELETE FROM packages WHERE name = ?', (name,))
+            referenced[digest].discard(name)
+            if not referenced[digest]:
+                self._drop(db, digest)
+                total -= sizes[digest]
+
+    def size(self):
+        with closing(self._connect()) as db:
+            return db.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM packages)').fetchone()[0]
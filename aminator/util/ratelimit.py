@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.util.ratelimit
+=======================
+host-wide API rate limiting shared by concurrent aminator processes
+"""
+import json
+import logging
+import os
+import time
+from fcntl import flock, LOCK_EX, LOCK_UN
+
+from aminator.util.linux import mkdir_p
+
+
+log = logging.getLogger(__name__)
+
+DESCRIBE = 'describe'
+MUTATE = 'mutate'
+
+THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+
+def api_class(action):
+    """ read-only calls draw from the describe budget, everything else from mutate """
+    if action.startswith(('Describe', 'Get', 'List')):
+        return DESCRIBE
+    return MUTATE
+
+
+class TokenBucket(object):
+    """
+    a token bucket whose state lives in a file, so every process on the host draws from
+    the same bucket. the refill rate adapts AIMD style: it grows by increase requests/s
+    for every second without throttling and is multiplied by decrease when throttled.
+    """
+
+    def __init__(self, path, rate, burst, min_rate, max_rate, increase=0.1, decrease=0.5, cooldown=1):
+        self._path = path
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._min_rate = float(min_rate)
+        self._max_rate = float(max_rate)
+        self._increase = float(increase)
+        self._decrease = float(decrease)
+        # throttles within cooldown seconds of a decrease are one event seen by several callers
+        self._cooldown = cooldown
+
+    def _update(self, func):
+        """ apply func to the refilled bucket state under an exclusive lock """
+        with open(self._path, 'a+') as fh:
+            flock(fh, LOCK_EX)
+            try:
+                fh.seek(0)
+                try:
+                    state = json.load(fh)
+                except ValueError:
+                    state = {'tokens': self._burst, 'rate': self._rate, 'updated': time.time(), 'decreased': 0}
+                now = time.time()
+                elapsed = max(0.0, now - state['updated'])
+                state['rate'] = min(self._max_rate, state['rate'] + self._increase * elapsed)
+                state['tokens'] = min(self._burst, state['tokens'] + state['rate'] * elapsed)
+                state['updated'] = now
+                result = func(state, now)
+                fh.seek(0)
+                fh.truncate()
+                json.dump(state, fh)
+                fh.flush()
+            finally:
+                flock(fh, LOCK_UN)
+        return result
+
+    def acquire(self):
+        """ block until a token is available and take it """
+        while True:
+            wait = self._update(self._take)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _take(self, state, now):
+        if state['tokens'] >= 1:
+            state['tokens'] -= 1
+            return 0
+        return (1 - state['tokens']) / state['rate']
+
+    def throttled(self):
+        self._update(self._throttle)
+
+    def _throttle(self, state, now):
+        if now - state['decreased'] < self._cooldown:
+            return
+        state['rate'] = max(self._min_rate, state['rate'] * self._decrease)
+        state['tokens'] = min(state['tokens'], 0)
+        state['decreased'] = now
+        log.debug('Throttled, {0} rate reduced to {1:.2f}/s'.format(os.path.basename(self._path), state['rate']))
+
+    def rate(self):
+        return self._update(lambda state, now: state['rate'])
+
+
+class RateLimiter(object):
+    """ one bucket per API class, shared by every process using the same state directory and scope """
+
+    def __init__(self, state_dir, scope, budgets, increase=0.1, decrease=0.5):
+        mkdir_p(state_dir)
+        self._buckets = {}
+        for name, budget in budgets.iteritems():
+            path = os.path.join(state_dir, '{0}.{1}'.format(scope, name))
+            self._buckets[name] = TokenBucket(path, budget['rate'], budget['burst'],
+                                              budget.get('min_rate', 1), budget.get('max_rate', budget['rate']),
+                                              increase=increase, decrease=decrease)
+
+    def bucket(self, action):
+        return self._buckets.get(api_class(action))
+
+    def acquire(self, action):
+        bucket = self.bucket(action)
+        if bucket is not None:
+            bucket.acquire()
+
+    def throttled(self, action):
+        bucket = self.bucket(action)
+        if bucket is not None:
+            log.debug('{0} was throttled'.format(action))
+            bucket.throttled()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+
+"""
+aminator.util.slots
+===================
+host-wide index of block device slots in use
+"""
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from time import time
+
+
+log = logging.getLogger(__name__)
+
+
+def process_starttime(pid):
+    """
+    the start time of a process in clock ticks since boot, which together with the pid
+    identifies it even after the pid is reused. None if the process does not exist
+    """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat:
+            data = stat.read()
+    except IOError:
+        return None
+    # comm may contain spaces and parentheses, the fields after it do not
+    return int(data.rsplit(')', 1)[1].split()[19])
+
+
+def process_alive(pid, starttime):
+    return starttime is not None and process_starttime(pid) == starttime
+
+
+class SlotIndex(object):
+    """
+    sqlite table of device slots and the processes holding them. claims happen in a single
+    write transaction, so concurrent allocators never hand out the same slot, and slots
+    whose holder has exited are reclaimed as part of the claim
+    """
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS slots (dev TEXT PRIMARY KEY, pid INTEGER NOT NULL, starttime INTEGER NOT NULL, claimed REAL NOT NULL)'
+
+    def __init__(self, path):
+        self._path = path
+        with closing(self._connect()) as db:
+            db.execute(self.SCHEMA)
+
+    def _connect(self):
+        # autocommit mode, transactions are explicit
+        return sqlite3.connect(self._path, timeout=60, isolation_level=None)
+
+    def _reap(self, db):
+        """ drop slots held by processes that no longer exist, returning the live ones """
+        live = {}
+        for dev, pid, starttime in db.execute('SELECT dev, pid, starttime FROM slots').fetchall():
+            if process_alive(pid, starttime):
+                live[dev] = pid
+            else:
+                log.debug('Reclaiming slot {0} from exited process {1}'.format(dev, pid))
+                db.execute('DELETE FROM slots WHERE dev = ? AND pid = ?', (dev, pid))
+        return live
+
+    def claim(self, candidates, exclude=()):
+        """
+        claim the first of candidates that is neither held nor excluded for this process
+        :return: the claimed device, or None if every candidate is taken
+        """
+        pid = os.getpid()
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                held = self._reap(db)
+                for dev in candidates:
+                    if dev not in held and dev not in exclude:
+                        db.execute('INSERT INTO slots (dev, pid, starttime, claimed) VALUES (?, ?, ?, ?)',
+                                   (dev, pid, process_starttime(pid), time()))
+                        db.execute('COMMIT')
+                        return dev
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        return None
+
+    def assign(self, dev, pid=None):
+        """ record dev as held by pid (default: this process), e.g. when a slot is handed over """
+        pid = pid or os.getpid()
+        with closing(self._connect()) as db:
+            db.execute('INSERT OR REPLACE INTO slots (dev, pid, starttime, claimed) VALUES (?, ?, ?, ?)',
+                       (dev, pid, process_starttime(pid), time()))
+
+    def release(self, dev, pid=None):
+        pid = pid or os.getpid()
+        with closing(self._connect()) as db:
+            db.execute('DELETE FROM slots WHERE dev = ? AND pid = ?', (dev, pid))
+
+    def occupied(self):
+        """ devices held by live processes """
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                held = self._reap(db)
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        return held
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+from datetime import datetime, timedelta
+
+from bunch import Bunch
+from boto.ec2 import EC2Connection
+from boto.exception import EC2ResponseError
+from boto.ec2.image import Image
+from boto.ec2.instance import Instance
+from boto.ec2.volume import Volume
+
+from aminator.plugins.cloud.ec2 import EC2CloudPlugin, VOLUME_POOL_TAG
+from aminator.plugins.cloud.ec2_local import EC2LocalCloudPlugin
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.counts = {}
+
+    def increment(self, metric_name, value=1):
+        self.counts[metric_name] = self.counts.get(metric_name, 0) + value
+
+    def timer(self, *args, **kwargs):
+        pass
+
+
+def test_metrics_wrapped_once(monkeypatch):
+    # the plugins patch boto's classes, put every method back as it was when the test is done
+    for cls in (EC2Connection, Volume, Image, Instance):
+        for name, value in vars(cls).items():
+            if callable(value):
+                monkeypatch.setattr(cls, name, value)
+    monkeypatch.setattr(EC2Connection, 'get_all_images', lambda connection, *args, **kwargs: ['ami-1'])
+    metrics = Metrics()
+    for plugin_class in (EC2CloudPlugin, EC2LocalCloudPlugin):
+        plugin = plugin_class()
+        plugin._config = Bunch(metrics=metrics)
+    EC2Connection.get_all_images(EC2Connection.__new__(EC2Connection))
+    assert metrics.counts == {'aminator.cloud.ec2.connection.get_all_images.count': 1}
+
+
+class PooledVolume(object):
+    def __init__(self, volume_id, attached_elsewhere=False, created=None, deleted=None):
+        self.id = volume_id
+        self.attached_elsewhere = attached_elsewhere
+        self.attached_to = None
+        self.tags = {VOLUME_POOL_TAG: 'snap-1:10:gp2', 'status': 'pooled'}
+        self.create_time = '{0:%Y-%m-%dT%H:%M:%S.000Z}'.format(created or datetime.utcnow())
+        self.deleted = deleted
+
+    def attach(self, instance_id, device):
+        if self.attached_elsewhere:
+            body = ('<Response><Errors><Error><Code>VolumeInUse</Code><Message>{0} is already attached to an instance'
+                    '</Message></Error></Errors><RequestID>1</RequestID></Response>'.format(self.id))
+            raise EC2ResponseError(400, 'Bad Request', body)
+        self.attached_to = instance_id
+        return True
+
+    def delete(self):
+        self.deleted.append(self.id)
+        return True
+
+
+class PoolConnection(object):
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.tagged = {}
+
+    def get_all_volumes(self, filters=None):
+        return list(self.volumes)
+
+    def create_tags(self, resource_ids, tags):
+        for resource_id in resource_ids:
+            self.tagged[resource_id] = tags
+
+
+def pool_plugin(volumes):
+    plugin = EC2CloudPlugin.__new__(EC2CloudPlugin)
+    plugin._config = Bunch(metrics=Metrics(), plugins=Bunch({plugin.full_name: Bunch(volume_pool_size=2, provisioner_ebs_type='gp2')}),
+                           context=Bunch(ami=Bunch(), cloud=Bunch(), volume=Bunch(),
+                                         base_ami=Bunch(id='ami-1', name='base', architecture='x86_64',
+                                                        root_device_name='/dev/sda1',
+                                                        block_device_mapping={'/dev/sda1': Bunch(size=10, snapshot_id='snap-1')})))
+    plugin._instance = Bunch(id='i-1', placement='us-east-1a')
+    plugin._connection = PoolConnection(volumes)
+    plugin._refill_volume_pool = lambda *args: None
+    return plugin
+
+
+def test_pooled_volume_claimed_by_attach():
+    volumes = [PooledVolume('vol-1', attached_elsewhere=True), PooledVolume('vol-2')]
+    plugin = pool_plugin(volumes)
+    plugin.allocate_base_volume(tag=False)
+    plugin._attach_base_volume('/dev/sdf')
+    assert plugin._volume.id == 'vol-2'
+    assert volumes[1].attached_to == 'i-1'
+    assert plugin._connection.tagged == {'vol-2': {'status': 'claimed', 'claimed-by': 'i-1'}}
+    assert plugin._config.metrics.counts == {'aminator.cloud.ec2.volume_pool.hit': 1}
+
+
+def test_pool_exhausted_by_other_hosts():
+    plugin = pool_plugin([PooledVolume('vol-1', attached_elsewhere=True)])
+    plugin.allocate_base_volume(tag=False)
+    created = []
+
+    def new_base_volume():
+        created.append(plugin._volume_spec)
+        plugin._pooled = False
+        plugin._volume = PooledVolume('vol-new')
+        return True
+    plugin._new_base_volume = new_base_volume
+    plugin._attach_base_volume('/dev/sdf')
+    assert created == [(10, 'gp2', 'snap-1', None)]
+    assert plugin._volume.attached_to == 'i-1'
+    assert plugin._connection.tagged == {}
+    assert plugin._config.metrics.counts == {'aminator.cloud.ec2.volume_pool.miss': 1}
+
+
+def test_sweep_volume_pools():
+    deleted = []
+    volumes = [PooledVolume('vol-old', created=datetime.utcnow() - timedelta(days=2), deleted=deleted),
+               PooledVolume('vol-new', deleted=deleted)]
+    plugin = pool_plugin(volumes)
+    plugin._sweep_volume_pools(86400)
+    assert deleted == ['vol-old']
+    assert plugin._config.metrics.counts == {'aminator.cloud.ec2.volume_pool.expired': 1}
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+import socket
+import threading
+import time
+
+from boto.exception import BotoServerError
+
+import aminator.util.ec2
+from aminator.util.ec2 import ResourceWaiter, estimate_completion, parse_progress
+from aminator.util.ec2 import instance_identity, invalidate_instance_identity
+from aminator.util.ec2 import ImageCache
+from aminator.util.linux import daemonize
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+
+class Volume(object):
+    def __init__(self, id, status='creating'):
+        self.id = id
+        self.status = status
+
+    def _update(self, updated):
+        self.__dict__.update(updated.__dict__)
+
+
+class FakeConnection(object):
+    def __init__(self, states):
+        self.states = states
+        self.calls = []
+
+    def get_all_volumes(self, filters=None):
+        ids = filters['volume-id']
+        self.calls.append(sorted(ids))
+        return [Volume(vol_id, self.states[vol_id].pop(0)) for vol_id in ids if vol_id in self.states]
+
+
+class TestResourceWaiter(object):
+
+    def test_batched_wait(self):
+        connection = FakeConnection({
+            'vol-1': ['creating', 'available'],
+            'vol-2': ['creating', 'available'],
+        })
+        waiter = ResourceWaiter(connection, interval=0.05)
+        volumes = [Volume('vol-1'), Volume('vol-2')]
+        results = {}
+
+        def wait(volume):
+            results[volume.id] = waiter.wait(volume, 'available', timeout=5)
+
+        threads = [threading.Thread(target=wait, args=(volume,)) for volume in volumes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == {'vol-1': True, 'vol-2': True}
+        assert all(volume.status == 'available' for volume in volumes)
+        assert ['vol-1', 'vol-2'] in connection.calls
+
+    def test_failed_state(self):
+        connection = FakeConnection({'vol-1': ['error']})
+        waiter = ResourceWaiter(connection, interval=0.01)
+        assert not waiter.wait(Volume('vol-1'), 'available', timeout=5)
+
+    def test_invisible_resource_times_out(self):
+        connection = FakeConnection({})
+        waiter = ResourceWaiter(connection, interval=0.01)
+        assert not waiter.wait(Volume('vol-1'), 'available', timeout=0.1)
+
+    def test_describe_errors(self):
+        connection = FakeConnection({'vol-1': ['creating', 'available']})
+        describe = connection.get_all_volumes
+        failures = [socket.error('connection reset'), BotoServerError(503, 'Service Unavailable')]
+
+        def get_all_volumes(filters=None):
+            if failures:
+                raise failures.pop(0)
+            return describe(filters)
+        connection.get_all_volumes = get_all_volumes
+        waiter = ResourceWaiter(connection, interval=0.01)
+        assert waiter.wait(Volume('vol-1'), 'available', timeout=5)
+        assert not failures
+
+    def test_poller_restarted(self):
+        connection = FakeConnection({'vol-1': ['available'], 'vol-2': ['available']})
+        waiter = ResourceWaiter(connection, interval=0.01)
+        waiter.POLLER_CHECK = 0.05
+        check = waiter._check
+        failures = [RuntimeError('poller bug')]
+
+        def failing_check(kind, entries):
+            if failures:
+                raise failures.pop(0)
+            return check(kind, entries)
+        waiter._check = failing_check
+        assert waiter.wait(Volume('vol-1'), 'available', timeout=5)
+        assert not failures
+        assert waiter.wait(Volume('vol-2'), 'available', timeout=5)
+
+
+class TestSnapshotEstimate(object):
+
+    def test_parse_progress(self):
+        assert parse_progress('45%') == 45.0
+        assert parse_progress('') is None
+        assert parse_progress(None) is None
+
+    def test_estimate_completion(self):
+        assert estimate_completion([]) is None
+        assert estimate_completion([(0, 0.0), (10, 0.0)]) is None
+        # 10% every 10s leaves 50% to go
+        assert estimate_completion([(0, 30.0), (10, 40.0), (20, 50.0)]) == 50.0
+
+    def test_estimate_uses_recent_rate(self):
+        samples = [(0, 0.0), (100, 10.0), (110, 20.0), (120, 30.0)]
+        assert estimate_completion(samples, window=3) == 70.0
+
+
+class TestInstanceIdentity(object):
+
+    def test_cached_until_invalidated(self, monkeypatch):
+        calls = []
+
+        def get_instance_metadata(**kwargs):
+            calls.append(kwargs)
+            return {
+                'instance-id': 'i-{0}'.format(len(calls)),
+                'placement': {'availability-zone': 'us-east-1a'},
+                'local-ipv4': '10.0.0.1',
+            }
+
+        monkeypatch.setattr(aminator.util.ec2, 'get_instance_metadata', get_instance_metadata)
+        invalidate_instance_identity()
+
+        identity = instance_identity()
+        assert identity.instance_id == 'i-1'
+        assert identity.region == 'us-east-1'
+        assert identity.public_hostname is None
+        assert instance_identity() is identity
+        assert len(calls) == 1
+
+        invalidate_instance_identity()
+        assert instance_identity().instance_id == 'i-2'
+        assert instance_identity(refresh=True).instance_id == 'i-3'
+        invalidate_instance_identity()
+
+
+def image(image_id, name, version):
+    return {
+        'id': image_id,
+        'name': name,
+        'root_device_name': '/dev/sda1',
+        'block_device_mapping': {'/dev/sda1': {'snapshot_id': 'snap-1', 'size': 10}},
+        'kernel_id': None,
+        'ramdisk_id': None,
+        'architecture': 'x86_64',
+        'virtualization_type': 'hvm',
+        'tags': {'base_ami_version': version},
+    }
+
+
+class TestImageCache(object):
+
+    def test_lookup_by_name_and_id(self, tmpdir):
+        cache = ImageCache(str(tmpdir.join('cache.sqlite')), 'us-east-1')
+        assert cache.by_name('base') is None
+        cache.put([image('ami-1', 'base', '1'), image('ami-2', 'other', '1')])
+
+        record, fresh = cache.by_name('base')
+        assert fresh
+        assert record.id == 'ami-1'
+        assert record.block_device_mapping[record.root_device_name].size == 10
+        assert record.tags.get('base_ami_version') == '1'
+        assert cache.by_id('ami-2')[0].name == 'other'
+
+        # names and ids are per region
+        assert ImageCache(str(tmpdir.join('cache.sqlite')), 'us-west-2').by_id('ami-1') is None
+
+    def test_republished_name(self, tmpdir):
+        cache = ImageCache(str(tmpdir.join('cache.sqlite')), 'us-east-1')
+        cache.put([image('ami-1', 'base', '1')])
+        cache.put([image('ami-2', 'base', '2')])
+        assert cache.by_name('base')[0].id == 'ami-2'
+
+    def test_ttl(self, tmpdir):
+        cache = ImageCache(str(tmpdir.join('cache.sqlite')), 'us-east-1', ttl=0)
+        cache.put([image('ami-1', 'base', '1')])
+        record, fresh = cache.by_id('ami-1')
+        assert not fresh
+
+
+def test_daemonize_renews_identity_lock(tmpdir):
+    result = tmpdir.join('result')
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with aminator.util.ec2._identity_lock:
+            held.set()
+            release.wait(10)
+
+    def daemon():
+        result.write(str(aminator.util.ec2._identity_lock.acquire(False)))
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    held.wait(10)
+    try:
+        daemonize(daemon)
+    finally:
+        release.set()
+        thread.join()
+    for _ in xrange(100):
+        if result.check() and result.read():
+            break
+        time.sleep(0.05)
+    assert result.read() == 'True'
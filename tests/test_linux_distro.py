@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+
+import pytest
+from bunch import Bunch
+
+from aminator.exceptions import VolumeException
+from aminator.plugins.distro.redhat import RedHatDistroPlugin
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+
+class SetupFailure(RedHatDistroPlugin):
+    """ a distro plugin whose chroot setup fails after entering its mount namespace """
+    def __init__(self, failure):
+        super(SetupFailure, self).__init__()
+        self.failure = failure
+        self.calls = []
+        self._config = Bunch(volume_dir='/var/aminator/volumes', context=Bunch(volume=Bunch(dev='/dev/xvdf')),
+                             plugins=Bunch({self.full_name: Bunch(private_mount_namespace=True)}))
+
+    def _enter_mount_namespace(self):
+        self.calls.append('enter')
+        self._host_namespace = 3
+
+    def _leave_mount_namespace(self):
+        self.calls.append('leave')
+        self._host_namespace = None
+        return True
+
+    def _configure_chroot(self):
+        self.calls.append('configure')
+        if self.failure:
+            raise self.failure
+        return False
+
+    def _teardown_chroot_mounts(self):
+        self.calls.append('teardown')
+        # failed to release the package cache, before leaving the namespace
+        return False
+
+
+@pytest.mark.parametrize('failure', [None, OSError(16, 'Device or resource busy')])
+def test_failed_setup_leaves_namespace(failure):
+    plugin = SetupFailure(failure)
+    with pytest.raises(VolumeException):
+        plugin.__enter__()
+    assert plugin.calls == ['enter', 'configure', 'teardown', 'leave']
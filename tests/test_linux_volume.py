@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+
+import pytest
+from bunch import Bunch
+
+from aminator.plugins.volume.linux import LinuxVolumePlugin
+from aminator.util.linux import monitor_command, probe_filesystem
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+MB = 1024 ** 2
+
+
+def volume_plugin(dev, **volume):
+    plugin = LinuxVolumePlugin.__new__(LinuxVolumePlugin)
+    plugin._config = Bunch(plugins=Bunch({plugin.full_name: Bunch(resize_threshold=16)}),
+                           context=Bunch(volume=Bunch(dev=dev, **volume)))
+    plugin._dev = dev
+    return plugin
+
+
+@pytest.fixture
+def image(tmpdir):
+    """ an 8MB ext4 filesystem at the start of a 64MB device """
+    path = str(tmpdir.join('volume.img'))
+    with open(path, 'w') as fh:
+        fh.truncate(64 * MB)
+    if not monitor_command(['mkfs.ext4', '-q', '-F', path, '8M']).success:
+        pytest.skip('mkfs.ext4 unavailable')
+    return path
+
+
+def test_grow_larger_volume(image):
+    plugin = volume_plugin(image, size=128 * MB, base_size=64 * MB)
+    assert plugin._needs_grow(probe_filesystem(image)[1])
+
+
+def test_grow_small_filesystem(image):
+    # the volume is the size of its base, but the filesystem in it is not
+    plugin = volume_plugin(image, size=64 * MB, base_size=64 * MB)
+    assert probe_filesystem(image)[1] == 8 * MB
+    assert plugin._needs_grow(probe_filesystem(image)[1])
+    assert volume_plugin(image)._needs_grow(8 * MB)
+
+
+def test_filesystem_fills_volume(image):
+    plugin = volume_plugin(image, size=64 * MB, base_size=64 * MB)
+    assert not plugin._needs_grow(64 * MB - MB)
+    assert not volume_plugin(image)._needs_grow(64 * MB)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+import os
+import time
+
+from aminator.config import Config
+from aminator.plugins.provisioner.apt import AptProvisionerPlugin
+from aminator.plugins.provisioner.yum import YumProvisionerPlugin
+from aminator.util.metadata import MetadataCache, configuration_key, is_fresh, is_refreshed, metadata_age, metadata_files, touch_stamp
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+
+def test_freshness(tmpdir):
+    lists = tmpdir.mkdir('var').mkdir('lib').mkdir('lists')
+    lists.join('a_InRelease').write('a')
+    lists.join('b_Release').write('b')
+    lists.join('a_Packages').write('packages')
+    files = metadata_files(str(tmpdir), ['/var/lib/lists/*Release'])
+    assert [os.path.basename(path) for path in files] == ['a_InRelease', 'b_Release']
+    assert is_fresh(files, 60)
+    stale = time.time() - 120
+    os.utime(files[1], (stale, stale))
+    assert 120 <= metadata_age(files) < 130
+    assert not is_fresh(files, 60)
+    assert metadata_age([]) is None
+    assert not is_fresh([], 60)
+
+
+def age(path, seconds):
+    then = time.time() - seconds
+    os.utime(str(path), (then, then))
+
+
+def test_refresh_stamp(tmpdir):
+    # downloaded indexes carry the repository's Last-Modified time, long before the fetch
+    lists = tmpdir.mkdir('lists')
+    lists.join('a_Release').write('a')
+    age(lists.join('a_Release'), 86400)
+    stamp = str(tmpdir.join('periodic', 'update-success-stamp'))
+    indexes = metadata_files(str(tmpdir), ['/lists/*Release'])
+    assert not is_refreshed(stamp, indexes, 60)
+    touch_stamp(stamp)
+    assert is_refreshed(stamp, indexes, 60)
+    assert not is_refreshed(stamp, [], 60)
+    age(stamp, 120)
+    assert not is_refreshed(stamp, indexes, 60)
+
+
+def test_apt_metadata_fresh(tmpdir):
+    plugin = AptProvisionerPlugin.__new__(AptProvisionerPlugin)
+    plugin._config = Config()
+    plugin._config.context = Config(package=Config())
+    plugin._config.plugins = Config({plugin.full_name: Config(metadata_ttl=60,
+                                                              metadata_stamp='/var/lib/apt/periodic/update-success-stamp',
+                                                              metadata_files=['/var/lib/apt/lists/*Release'])})
+    lists = tmpdir.mkdir('var').mkdir('lib').mkdir('apt').mkdir('lists')
+    lists.join('a_InRelease').write('a')
+    age(lists.join('a_InRelease'), 86400)
+    assert not plugin._metadata_fresh(str(tmpdir))
+    touch_stamp(str(tmpdir.join('var', 'lib', 'apt', 'periodic', 'update-success-stamp')))
+    assert plugin._metadata_fresh(str(tmpdir))
+    # a release file fetched just now does not make a stale update fresh
+    lists.join('a_InRelease').write('b')
+    age(tmpdir.join('var', 'lib', 'apt', 'periodic', 'update-success-stamp'), 120)
+    assert not plugin._metadata_fresh(str(tmpdir))
+
+
+def test_yum_metadata_fresh(tmpdir):
+    config = Config(metadata_files=['/var/cache/yum/*/*/*/cachecookie'], clean_repos=['base'])
+    cache = tmpdir.mkdir('var').mkdir('cache').mkdir('yum').mkdir('x86_64').mkdir('6')
+    for repo in ('base', 'updates'):
+        cache.mkdir(repo).join('repomd.xml').write(repo)
+        age(cache.join(repo, 'repomd.xml'), 86400)
+    assert not YumProvisionerPlugin._metadata_fresh(config, 60, str(tmpdir))
+    cache.join('base', 'cachecookie').write('')
+    assert YumProvisionerPlugin._metadata_fresh(config, 60, str(tmpdir))
+    cache.join('updates', 'cachecookie').write('')
+    age(cache.join('updates', 'cachecookie'), 120)
+    assert YumProvisionerPlugin._metadata_fresh(config, 60, str(tmpdir))
+    config.clean_repos = []
+    assert not YumProvisionerPlugin._metadata_fresh(config, 60, str(tmpdir))
+
+
+def test_configuration_key(tmpdir):
+    tmpdir.mkdir('etc').join('sources.list').write('deb http://example.com/debian stable main')
+    key = configuration_key(str(tmpdir), ['/etc/sources.list', '/etc/sources.list.d/*'])
+    assert key == configuration_key(str(tmpdir), ['/etc/sources.list', '/etc/sources.list.d/*'])
+    tmpdir.join('etc').mkdir('sources.list.d').join('extra.list').write('deb http://example.com/extra stable main')
+    assert key != configuration_key(str(tmpdir), ['/etc/sources.list', '/etc/sources.list.d/*'])
+
+
+def test_metadata_cache(tmpdir):
+    cache = MetadataCache(str(tmpdir.join('cache')), 60)
+    lists = tmpdir.mkdir('lists')
+    lists.join('a_Release').write('a')
+    lists.join('a_Packages').write('packages')
+    assert not cache.fresh('key')
+    cache.export('key', str(lists), [str(lists.join('a_Release'))])
+    assert cache.fresh('key')
+    exported = tmpdir.join('cache', 'key', 'data', 'a_Packages')
+    assert exported.read() == 'packages'
+
+    # an unchanged release file only renews the entry
+    lists.join('a_Packages').write('changed')
+    cache.export('key', str(lists), [str(lists.join('a_Release'))])
+    assert exported.read() == 'packages'
+    lists.join('a_Release').write('b')
+    cache.export('key', str(lists), [str(lists.join('a_Release'))])
+    assert exported.read() == 'changed'
+
+    chroot_lists = tmpdir.mkdir('chroot_lists')
+    chroot_lists.join('stale_Release').write('stale')
+    cache.seed('key', str(chroot_lists))
+    assert sorted(os.listdir(str(chroot_lists))) == ['a_Packages', 'a_Release']
+    assert sorted(os.listdir(str(tmpdir.join('cache', 'key')))) == ['data', 'manifest.json']
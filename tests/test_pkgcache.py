@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+import os
+
+from aminator.util.pkgcache import PackageCache, file_digest
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+
+def download(stage, name, content):
+    path = os.path.join(stage, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fh:
+        fh.write(content)
+    return path
+
+
+def test_stage_and_harvest(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), 1024)
+    stage, seeded = cache.stage(['partial'])
+    assert seeded == 0
+    assert os.path.isdir(os.path.join(stage, 'partial'))
+    download(stage, 'a_1.0_amd64.deb', 'a' * 100)
+    download(stage, 'partial/b_1.0_amd64.deb', 'b' * 100)
+    download(stage, 'lock', '')
+    assert cache.harvest(stage, 'deb') == 2
+    assert not os.path.exists(stage)
+    assert cache.size() == 200
+
+    stage, seeded = cache.stage()
+    assert seeded == 2
+    path = os.path.join(stage, 'a_1.0_amd64.deb')
+    assert file_digest(path) == file_digest(download(str(tmpdir), 'a', 'a' * 100))
+    # seeded packages are not harvested again, identical content is stored once
+    download(stage, 'c_1.0_amd64.deb', 'a' * 100)
+    assert cache.harvest(stage, 'deb') == 1
+    assert cache.size() == 200
+
+
+def test_eviction(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), 250)
+    stage, seeded = cache.stage()
+    download(stage, 'old.rpm', 'o' * 100)
+    cache.harvest(stage, 'rpm')
+    held, seeded = cache.stage()
+    os.utime(os.path.join(held, 'old.rpm'), (0, 0))
+    stage, seeded = cache.stage()
+    download(stage, 'new.rpm', 'n' * 100)
+    download(stage, 'newer.rpm', 'N' * 100)
+    assert cache.harvest(stage, 'rpm') == 2
+    assert cache.size() == 200
+    # evicted packages stay intact in the stages seeded with them
+    with open(os.path.join(held, 'old.rpm')) as fh:
+        assert fh.read() == 'o' * 100
+    stage, seeded = cache.stage()
+    assert sorted(os.listdir(stage)) == ['new.rpm', 'newer.rpm']
+
+
+def test_abandoned_stage(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), 1024)
+    abandoned = tmpdir.join('cache', 'stage', '1.0.abandoned')
+    abandoned.ensure(dir=True)
+    cache.stage()
+    assert not abandoned.exists()
+
+
+def objects(tmpdir):
+    return sorted(filename for root, dirs, files in os.walk(str(tmpdir.join('cache', 'objects'))) for filename in files)
+
+
+def test_replaced_package(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), 1024)
+    stage, seeded = cache.stage()
+    download(stage, 'repodata.rpm', 'v1' * 50)
+    cache.harvest(stage, 'rpm')
+    # the same name with new content replaces the old object instead of orphaning it
+    stage, seeded = cache.stage()
+    os.unlink(os.path.join(stage, 'repodata.rpm'))
+    new = download(stage, 'repodata.rpm', 'v2' * 50)
+    digest = file_digest(new)
+    assert cache.harvest(stage, 'rpm') == 1
+    assert objects(tmpdir) == [digest]
+    assert cache.size() == 100
+    # objects left behind by a harvest that died are removed by the next one
+    orphan = tmpdir.join('cache', 'objects', 'ff', 'f' * 64)
+    orphan.write('orphan', ensure=True)
+    stage, seeded = cache.stage()
+    cache.harvest(stage, 'rpm')
+    assert not orphan.exists()
+
+
+def test_modified_object(tmpdir):
+    cache = PackageCache(str(tmpdir.join('cache')), 1024)
+    stage, seeded = cache.stage()
+    download(stage, 'a.deb', 'a' * 100)
+    download(stage, 'b.deb', 'b' * 100)
+    cache.harvest(stage, 'deb')
+    # touched but intact, still seeded
+    stage, seeded = cache.stage()
+    os.utime(os.path.join(stage, 'b.deb'), (0, 0))
+    # rewritten in place through the hard link of a seeded stage
+    with open(os.path.join(stage, 'a.deb'), 'r+') as fh:
+        fh.write('corrupt')
+    stage, seeded = cache.stage()
+    assert os.listdir(stage) == ['b.deb']
+    assert cache.size() == 100
+    assert len(objects(tmpdir)) == 1
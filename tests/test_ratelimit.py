@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+import socket
+from httplib import HTTPException
+
+import pytest
+from boto.exception import BotoServerError
+from bunch import Bunch
+
+import aminator.plugins.cloud.ec2
+import aminator.util.ratelimit
+from aminator.plugins.cloud.ec2 import EC2CloudPlugin
+from aminator.util.ratelimit import RateLimiter, TokenBucket, api_class
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(object):
+    def setup_method(self, method):
+        self.clock = Clock()
+        self._time = aminator.util.ratelimit.time
+        aminator.util.ratelimit.time = self.clock
+
+    def teardown_method(self, method):
+        aminator.util.ratelimit.time = self._time
+
+    def test_burst_then_wait(self, tmpdir):
+        bucket = TokenBucket(str(tmpdir.join('bucket')), rate=2, burst=3, min_rate=1, max_rate=2)
+        for _ in xrange(3):
+            bucket.acquire()
+        assert self.clock.slept == []
+        bucket.acquire()
+        assert self.clock.slept == [0.5]
+
+    def test_shared_state(self, tmpdir):
+        path = str(tmpdir.join('bucket'))
+        TokenBucket(path, rate=1, burst=1, min_rate=1, max_rate=1).acquire()
+        TokenBucket(path, rate=1, burst=1, min_rate=1, max_rate=1).acquire()
+        assert self.clock.slept == [1.0]
+
+    def test_aimd(self, tmpdir):
+        bucket = TokenBucket(str(tmpdir.join('bucket')), rate=8, burst=8, min_rate=1, max_rate=10,
+                             increase=0.5, decrease=0.5)
+        bucket.throttled()
+        assert bucket.rate() == 4
+        # a second throttle from the same burst is not counted again
+        bucket.throttled()
+        assert bucket.rate() == 4
+        self.clock.now += 4
+        assert bucket.rate() == 6
+        self.clock.now += 100
+        assert bucket.rate() == 10
+        for _ in xrange(10):
+            self.clock.now += 1
+            bucket.throttled()
+        assert 1 <= bucket.rate() < 2
+
+
+def test_api_class():
+    assert api_class('DescribeImages') == 'describe'
+    assert api_class('CreateTags') == 'mutate'
+
+
+def test_limiter_budgets(tmpdir):
+    limiter = RateLimiter(str(tmpdir.join('ratelimit')), 'us-east-1', {'describe': {'rate': 5, 'burst': 5}})
+    limiter.acquire('DescribeVolumes')
+    # calls without a budget are not limited
+    limiter.acquire('CreateVolume')
+    assert tmpdir.join('ratelimit', 'us-east-1.describe').check()
+    assert not tmpdir.join('ratelimit', 'us-east-1.mutate').check()
+
+
+class Metrics(object):
+    def increment(self, *args, **kwargs):
+        pass
+
+    def gauge(self, *args, **kwargs):
+        pass
+
+
+THROTTLED = ('<?xml version="1.0" encoding="UTF-8"?><Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+             '<Message>Request limit exceeded.</Message></Error></Errors><RequestID>1</RequestID></Response>')
+
+
+class ThrottlingConnection(object):
+    """ a boto connection whose first requests fail, throttled unless told otherwise """
+    num_retries = 6
+    http_exceptions = (HTTPException, socket.error)
+    http_unretryable_exceptions = []
+
+    def __init__(self, failures, error=None):
+        self.failures = failures
+        self.error = error or BotoServerError(503, 'Service Unavailable', THROTTLED)
+        self.calls = 0
+
+    def _mexe(self, request, sender=None, override_num_retries=None, retry_handler=None):
+        return override_num_retries
+
+    def make_request(self, action, *args, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return 'response'
+
+
+def limited_connection(tmpdir, failures, error=None):
+    plugin = EC2CloudPlugin.__new__(EC2CloudPlugin)
+    plugin._config = Bunch(metrics=Metrics())
+    limiter = RateLimiter(str(tmpdir.join('ratelimit')), 'us-east-1',
+                          {'describe': {'rate': 100, 'burst': 100, 'min_rate': 1}}, increase=0)
+    connection = ThrottlingConnection(failures, error)
+    plugin._limit_connection(connection, limiter)
+    return connection, limiter
+
+
+def test_boto_throttling(tmpdir):
+    connection, limiter = limited_connection(tmpdir, 1)
+    assert connection.num_retries == 0
+    # boto's own retries are off whatever its config file says
+    assert connection._mexe(None, override_num_retries=5) == 0
+    assert connection.make_request('DescribeVolumes') == 'response'
+    assert connection.calls == 2
+    assert limiter.bucket('DescribeVolumes').rate() == 50
+
+
+def test_boto_throttling_exhausted(tmpdir):
+    connection, limiter = limited_connection(tmpdir, 100)
+    with pytest.raises(BotoServerError) as raised:
+        connection.make_request('DescribeVolumes')
+    assert raised.value.error_code == 'RequestLimitExceeded'
+    assert connection.calls == 7
+
+
+def test_boto_unpaced_retries(tmpdir, monkeypatch):
+    slept = []
+    monkeypatch.setattr(aminator.plugins.cloud.ec2, 'sleep', slept.append)
+    # errors boto itself would have retried
+    connection, limiter = limited_connection(tmpdir, 2, socket.error(104, 'Connection reset by peer'))
+    assert connection.make_request('DescribeVolumes') == 'response'
+    assert slept == [1, 2]
+    # throttled actions without a bucket back off on their own
+    del slept[:]
+    connection, limiter = limited_connection(tmpdir, 100)
+    with pytest.raises(BotoServerError) as raised:
+        connection.make_request('CreateTags')
+    assert raised.value.error_code == 'RequestLimitExceeded'
+    assert connection.calls == 7
+    assert slept == [1, 2, 4, 8, 16, 20]
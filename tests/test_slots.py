@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+#
+#
+#  Copyright 2013 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+#
+#
+import logging
+import os
+import subprocess
+
+from aminator.util.slots import SlotIndex, process_alive, process_starttime
+
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+# add the handler to the root logger
+logging.getLogger('').addHandler(console)
+
+DEVICES = ['/dev/xvdf', '/dev/xvdg', '/dev/xvdh']
+
+
+def test_process_starttime():
+    assert process_alive(os.getpid(), process_starttime(os.getpid()))
+    assert not process_alive(os.getpid(), process_starttime(os.getpid()) + 1)
+
+
+def test_claim(tmpdir):
+    index = SlotIndex(str(tmpdir.join('slots.sqlite')))
+    assert index.claim(DEVICES) == '/dev/xvdf'
+    assert index.claim(DEVICES, exclude=['/dev/xvdg']) == '/dev/xvdh'
+    assert index.claim(DEVICES) == '/dev/xvdg'
+    assert index.claim(DEVICES) is None
+    index.release('/dev/xvdh')
+    assert index.claim(DEVICES) == '/dev/xvdh'
+    assert sorted(index.occupied()) == DEVICES
+
+
+def test_reclaim_exited(tmpdir):
+    index = SlotIndex(str(tmpdir.join('slots.sqlite')))
+    child = subprocess.Popen(['sleep', '30'])
+    index.assign('/dev/xvdf', child.pid)
+    assert index.claim(DEVICES) == '/dev/xvdg'
+    child.kill()
+    child.wait()
+    assert index.claim(DEVICES) == '/dev/xvdf'
+    assert index.occupied() == {'/dev/xvdf': os.getpid(), '/dev/xvdg': os.getpid()}
@@ -3,7 +3,12 @@ import unittest
 import os
 import logging
 import shutil
+import stat
+import struct
+import subprocess
 import tempfile
+import threading
+import time
 
 log = logging.getLogger(__name__)
 logging.root.addHandler(logging.StreamHandler())
@@ -63,6 +68,152 @@ class linux_util(unittest.TestCase):
 
         assert install_status & remove_status
 
+    def test_wait_for_node(self):
+        """ a udev style symlink to a block device wakes the waiter on creation and removal """
+        devices = [os.path.join('/dev', name) for name in os.listdir('/dev')
+                   if stat.S_ISBLK(os.lstat(os.path.join('/dev', name)).st_mode)]
+        if not devices:
+            raise unittest.SkipTest('no block devices available')
+        watch_dir = tempfile.mkdtemp(dir='/tmp', prefix='dev_')
+        link = os.path.join(watch_dir, 'xvdf')
+        try:
+            assert not aminator.util.linux.wait_for_node(link, exists=True, timeout=0.1)
+            threading.Timer(0.2, os.symlink, (devices[0], link)).start()
+            start = time.time()
+            assert aminator.util.linux.wait_for_node(link, exists=True, timeout=10)
+            assert time.time() - start < 5
+            threading.Timer(0.2, os.unlink, (link,)).start()
+            assert aminator.util.linux.wait_for_node(link, exists=False, timeout=10)
+        finally:
+            shutil.rmtree(watch_dir)
+
+    def test_ext_used_extents(self):
+        image = tempfile.mktemp(dir='/tmp', prefix='ext_')
+        try:
+            with open(image, 'w') as fh:
+                fh.truncate(16 * 1024 * 1024)
+            if not aminator.util.linux.monitor_command(['mkfs.ext4', '-q', '-F', image]).success:
+                raise unittest.SkipTest('mkfs.ext4 unavailable')
+            extents = aminator.util.linux.ext_used_extents(image)
+            used = sum(length for (offset, length) in extents)
+            assert extents[0][0] == 0
+            assert 0 < used < 16 * 1024 * 1024
+            assert aminator.util.linux.read_extents(image, extents, readers=2, chunk_size=64 * 1024) >= used
+        finally:
+            os.unlink(image)
+        assert aminator.util.linux.ext_used_extents('/dev/null') is None
+
+    def test_probe_filesystem(self):
+        image = tempfile.mktemp(dir='/tmp', prefix='fs_')
+        try:
+            with open(image, 'w') as fh:
+                fh.truncate(16 * 1024 * 1024)
+            assert aminator.util.linux.probe_filesystem(image) == (None, None)
+            # hand-made superblocks, mkfs.xfs and mkfs.btrfs are rarely around
+            with open(image, 'r+b') as fh:
+                fh.write(struct.pack('>4sIQ', 'XFSB', 4096, 2048))
+            assert aminator.util.linux.probe_filesystem(image) == ('xfs', 8 * 1024 * 1024)
+            with open(image, 'r+b') as fh:
+                fh.write('\0' * 16)
+                fh.seek(0x10040)
+                fh.write('_BHRfS_M')
+                fh.seek(0x10070)
+                fh.write(struct.pack('<Q', 12 * 1024 * 1024))
+            assert aminator.util.linux.probe_filesystem(image) == ('btrfs', 12 * 1024 * 1024)
+            if not aminator.util.linux.monitor_command(['mkfs.ext4', '-q', '-F', image]).success:
+                raise unittest.SkipTest('mkfs.ext4 unavailable')
+            assert aminator.util.linux.probe_filesystem(image) == ('ext4', 16 * 1024 * 1024)
+        finally:
+            os.unlink(image)
+
+    def test_mount_table(self):
+        entry = aminator.util.linux.parse_mountinfo(
+            '36 35 98:0 /mnt1 /mnt/a\\040b rw,noatime master:1 - ext3 /dev/root rw,errors=continue')
+        assert entry == aminator.util.linux.MountInfo(36, 35, '/dev/root', 'ext3', '/mnt/a b', 'rw,noatime')
+        table = aminator.util.linux.MountTable()
+        try:
+            assert table.is_mounted('/')
+            assert table.is_mounted('/proc/')
+            assert not table.is_mounted(tempfile.gettempdir() + '/aminator-not-mounted')
+            assert '/proc' in table.under('/proc')
+            assert '/' not in table.under('/proc')
+        finally:
+            table.close()
+
+    def test_private_mount_namespace(self):
+        mountpoint = tempfile.mkdtemp(dir='/tmp', prefix='ns_')
+        host = aminator.util.linux.mount_namespace()
+        try:
+            try:
+                fd = aminator.util.linux.private_mount_namespace()
+            except OSError:
+                raise unittest.SkipTest('unable to unshare the mount namespace')
+            try:
+                private = aminator.util.linux.mount_namespace()
+                assert private != host
+                assert aminator.util.linux.mount_namespace_pids(private) == [os.getpid()]
+                spec = aminator.util.linux.MountSpec('tmpfs', 'tmpfs', mountpoint, None)
+                assert aminator.util.linux.mount(spec).success
+                assert aminator.util.linux.mounted(spec)
+            finally:
+                aminator.util.linux.leave_mount_namespace(fd)
+            assert aminator.util.linux.mount_namespace() == host
+            assert not aminator.util.linux.mounted(spec)
+            assert aminator.util.linux.mount_namespace_pids(private) == []
+        finally:
+            os.rmdir(mountpoint)
+
+    def test_mount_flags(self):
+        linux = aminator.util.linux
+        assert linux.mount_flags('proc', None) == (0, 0, None)
+        assert linux.mount_flags('bind', 'private') == (linux.MS_BIND, linux.MS_PRIVATE, None)
+        assert linux.mount_flags('tmpfs', 'ro,nosuid,size=1m,rslave') == (
+            linux.MS_RDONLY | linux.MS_NOSUID, linux.MS_SLAVE | linux.MS_REC, 'size=1m')
+
+    def test_mount_backends(self):
+        linux = aminator.util.linux
+        base = tempfile.mkdtemp(dir='/tmp', prefix='mount ')
+        try:
+            for backend in ('command', 'syscall'):
+                source = linux.MountSpec('tmpfs', 'tmpfs', os.path.join(base, 'source'), 'size=1m')
+                # bind base onto a mountpoint in the tmpfs, so unmounting the tmpfs needs recursion
+                target = linux.MountSpec(base, 'bind', os.path.join(source.mountpoint, 'target'), 'ro,private')
+                if not linux.mount(source, backend=backend).success:
+                    raise unittest.SkipTest('unable to mount')
+                try:
+                    assert linux.mount(target, backend=backend).success
+                    assert linux.mounted(target)
+                    assert linux.mount_table().get(target.mountpoint).options.startswith('ro')
+                    assert not linux.unmount(source, backend=backend).success
+                    assert linux.unmount(source, recursive=True, backend=backend).success
+                    assert not linux.mounted(target)
+                finally:
+                    linux.unmount(source, recursive=True, lazy=True)
+        finally:
+            shutil.rmtree(base)
+
+    def test_open_files(self):
+        linux = aminator.util.linux
+        root = tempfile.mkdtemp(dir='/tmp', prefix='busy_')
+        try:
+            with open(os.path.join(root, 'held'), 'w'):
+                files = linux.open_files(root)
+                assert [(f.pid, f.path) for f in files] == [(os.getpid(), os.path.join(root, 'held'))]
+                assert linux.busy_mount(root).success
+            assert linux.open_files(root) == []
+            assert not linux.busy_mount(root).success
+            child = subprocess.Popen(['sleep', '60'], cwd=root)
+            deadline = time.time() + 5
+            while not linux.open_files(root) and time.time() < deadline:
+                time.sleep(0.05)
+            assert [(f.pid, f.kind) for f in linux.open_files(root)] == [(child.pid, 'cwd')]
+            assert linux.chroot_processes(root) == []
+            assert child.pid in linux.chroot_processes('/')
+            child.kill()
+            child.wait()
+        finally:
+            shutil.rmtree(root)
+
 
 if __name__ == "__main__":
         unittest.main()